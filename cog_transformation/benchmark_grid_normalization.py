@@ -0,0 +1,79 @@
+"""Time of the longitude roll and latitude flip, per sort/reindex and shared.
+
+Builds a synthetic dataset on a 0 to 360 longitude, south to north latitude
+grid and normalises it the way the plugins used to (``sortby`` on the wrapped
+longitudes, then a latitude ``reindex`` per variable) and with
+``normalize_grid`` of the plugins. Every variable is materialised as a
+numpy array in both cases, as it is when its COG is written.
+
+    python benchmark_grid_normalization.py --variables 8 --repeat 3
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+import xarray
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from data_transformation_plugins.ecco_darwin_transformation import (
+    normalize_grid,
+    wrap_longitude,
+)
+
+# Resolution in degrees and latitude extent of the grids. The 1 km grid
+# covers a 10 degree band of latitudes, all longitudes, to fit in memory.
+GRIDS = {"0.5deg": (0.5, (-90, 90)), "1km": (1 / 120, (30, 40))}
+
+
+def synthetic_dataset(resolution, lat_range, variables):
+    lon = np.arange(0, 360, resolution)
+    lat = np.arange(lat_range[0], lat_range[1] + resolution / 2, resolution)
+    rng = np.random.default_rng(0)
+    return xarray.Dataset(
+        {
+            f"var{i}": (("lat", "lon"), rng.random((lat.size, lon.size), "float32"))
+            for i in range(variables)
+        },
+        coords={"lon": lon, "lat": lat},
+    )
+
+
+def sort_and_reindex(xds):
+    xds = xds.assign_coords(lon=wrap_longitude(xds.lon)).sortby("lon")
+    return [
+        np.asarray(xds[var].reindex(lat=list(reversed(xds[var].lat))))
+        for var in xds.data_vars
+    ]
+
+
+def shared_roll_and_flip(xds):
+    xds = normalize_grid(xds)
+    return [np.asarray(xds[var]) for var in xds.data_vars]
+
+
+def best_time(func, xds, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func(xds)
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variables", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'grid':8}{'shape':>14}{'before s':>10}{'after s':>10}{'speedup':>9}")
+    for name, (resolution, lat_range) in GRIDS.items():
+        xds = synthetic_dataset(resolution, lat_range, args.variables)
+        before, expected = best_time(sort_and_reindex, xds, args.repeat)
+        after, result = best_time(shared_roll_and_flip, xds, args.repeat)
+        assert all(np.array_equal(a, b) for a, b in zip(expected, result))
+        shape = "x".join(str(size) for size in xds["var0"].shape)
+        print(f"{name:8}{shape:>14}{before:10.3f}{after:10.3f}{before / after:9.1f}")
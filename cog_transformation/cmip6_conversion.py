@@ -0,0 +1,271 @@
+"""Conversion of the CMIP6 climdex netCDFs to COGs over a process pool.
+
+A task is a run of consecutive time steps of one source file, by default
+all of them: all their variables are sliced, encoded and uploaded, in order,
+by the worker process that gets the task. The file is read through
+``CachedNetCDF``, which keeps it open with a block cache sized to one time
+step and reads the next time step of the task while the current one is
+encoded. Every COG uploaded is sent straight back to the parent process,
+which keeps the manifest, records it and skips what previous runs converted,
+with the S3 GET requests it took. A failed task is reported and the others
+carry on.
+"""
+
+import hashlib
+import io
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import boto3
+import s3fs
+
+from cog_writer import TRANSFER_CONFIG, encode_cog
+from netcdf_reader import CachedNetCDF
+
+# Files each worker keeps open between its tasks
+OPEN_DATASETS = 2
+
+DATE_FMT = "%Y"
+
+# Per worker process, set by _init_worker
+_fs = None
+_s3_client = None
+_block_size = None
+_records = None
+_datasets = OrderedDict()
+
+
+def list_source_keys(s3_client, bucket, prefix):
+    """(key, ETag) of the netCDFs under ``prefix``, without the historical runs."""
+    keys = []
+    kwargs = {"Bucket": bucket, "Prefix": f"{prefix}/"}
+    while True:
+        resp = s3_client.list_objects_v2(**kwargs)
+        for obj in resp.get("Contents", []):
+            if obj["Key"].endswith(".nc") and "historical" not in obj["Key"]:
+                keys.append((obj["Key"], obj["ETag"].strip('"')))
+
+        try:
+            kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+        except KeyError:
+            break
+
+    return keys
+
+
+def _init_worker(profile, records, block_size=None):
+    global _fs, _s3_client, _block_size, _records
+    _block_size = block_size
+    _records = records
+    _fs = s3fs.S3FileSystem(profile=profile, anon=False)
+    _s3_client = boto3.Session(profile_name=profile).client("s3")
+
+
+def _wrap_longitude(xds):
+    return xds.assign_coords(lon=(((xds.lon + 180) % 360) - 180)).sortby("lon")
+
+
+def _open_dataset(bucket, key):
+    """Reader of ``key``, from the worker's open readers if it is one of them."""
+    if key in _datasets:
+        _datasets.move_to_end(key)
+        return _datasets[key]
+    reader = CachedNetCDF(
+        _fs, f"s3://{bucket}/{key}", block_size=_block_size, preprocess=_wrap_longitude
+    )
+    _datasets[key] = reader
+    if len(_datasets) > OPEN_DATASETS:
+        _datasets.popitem(last=False)[1].close()
+    return reader
+
+
+def _convert_time_step(
+    reader, key, time_increment, cog_bucket, prefix, converted, prefetch
+):
+    """Convert all variables of one time step of the file read by ``reader``.
+
+    The manifest record of every COG is sent to the parent once it is uploaded.
+    """
+    filename = key.split("/")[-1]
+    date = reader.dataset.time.isel(time=time_increment).dt.strftime(DATE_FMT).item()
+    todo = [var for var in reader.dataset.data_vars if (date, var) not in converted]
+    if not todo:
+        return
+    requests = reader.requests
+    xds = reader.time_step(time_increment, prefetch=prefetch)
+    for var in todo:
+        start_time = time.time()
+        data = xds[var]
+        data = data.isel(lat=slice(None, None, -1))
+        data.rio.set_spatial_dims("lon", "lat", inplace=True)
+        data.rio.write_crs("epsg:4326", inplace=True)
+
+        filename_elements = filename.split("_")
+        filename_elements[-1] = date
+        filename_elements.append(var)
+        cog_key = f"{prefix}/{'_'.join(filename_elements)}.tif"
+        body = encode_cog(data)
+        _s3_client.upload_fileobj(
+            io.BytesIO(body), cog_bucket, cog_key, Config=TRANSFER_CONFIG
+        )
+        _records.put(
+            {
+                "source_key": key,
+                "time": date,
+                "var": var,
+                "cog_key": cog_key,
+                "checksum": hashlib.sha256(body).hexdigest(),
+                "seconds": time.time() - start_time,
+                "s3_gets": reader.requests - requests,
+            }
+        )
+        requests = reader.requests
+
+
+def convert_time_steps(bucket, key, start, stop, cog_bucket, prefix, converted):
+    """Convert all variables of the time steps ``start`` to ``stop`` of ``key``.
+
+    ``stop=None`` converts up to the last time step of the file. The time
+    steps are converted in order by this worker, each one read while the
+    previous one is encoded. Variables whose ``(date, var)`` is in
+    ``converted`` are skipped. Returns the number of time steps of the file,
+    the parent gets the manifest records of the COGs as they are uploaded.
+    """
+    reader = _open_dataset(bucket, key)
+    count = len(reader)
+    stop = count if stop is None else min(stop, count)
+    for time_increment in range(start, stop):
+        _convert_time_step(
+            reader,
+            key,
+            time_increment,
+            cog_bucket,
+            prefix,
+            converted,
+            prefetch=time_increment + 1 < stop,
+        )
+    if stop == count:
+        # The last time steps of the file, its cache is not needed any more
+        _datasets.pop(key).close()
+    return count
+
+
+def convert(
+    prefixes,
+    raw_bucket,
+    cog_bucket,
+    manifest,
+    profile=None,
+    workers=4,
+    report_every=60,
+    block_size=None,
+    steps_per_task=None,
+):
+    """Convert the netCDFs under every prefix of ``raw_bucket`` to COGs.
+
+    The COGs of a prefix are written under the same prefix of
+    ``cog_bucket``. A task converts ``steps_per_task`` consecutive time
+    steps of a file, by default all of them, so that the worker reading a
+    file is the one that prefetches its next time step. The first task of a
+    file tells the number of its time steps, the tasks of its later time
+    steps are submitted once it is done. Every COG is recorded in
+    ``manifest`` as soon as it is uploaded. A failed task is printed and
+    its file is not marked complete, the other tasks carry on. Throughput
+    is printed every ``report_every`` seconds and at the end. Returns the
+    number of COGs written. ``block_size`` is the block size of the S3
+    reads, by default the size of one time step of a file.
+    """
+    s3_client = boto3.Session(profile_name=profile).client("s3")
+    sources = [
+        (prefix, key, etag)
+        for prefix in prefixes
+        for key, etag in list_source_keys(s3_client, raw_bucket, prefix)
+        if not manifest.is_complete(key, etag)
+    ]
+    print(f"{len(sources)} source files to convert")
+    etags = {key: etag for _, key, etag in sources}
+
+    start_time = last_report = time.time()
+    units_done = cogs_done = 0
+    unit_seconds = s3_gets = 0.0
+    failed = set()
+    context = multiprocessing.get_context("spawn")
+    # A worker has written the records of a task before the task is done
+    records = context.SimpleQueue()
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(profile, records, block_size),
+    ) as executor:
+
+        def submit(source, start, stop):
+            prefix, key, etag = source
+            unit = executor.submit(
+                convert_time_steps,
+                raw_bucket,
+                key,
+                start,
+                stop,
+                cog_bucket,
+                prefix,
+                manifest.converted(key, etag),
+            )
+            pending[unit] = (source, start, stop)
+            remaining[key] += 1
+
+        pending = {}
+        remaining = {key: 0 for key in etags}
+        for source in sources:
+            submit(source, 0, steps_per_task)
+        while pending:
+            # The records are written at least once a second
+            done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            while not records.empty():
+                record = records.get()
+                manifest.add_cog(
+                    record["source_key"],
+                    etags[record["source_key"]],
+                    record["time"],
+                    record["var"],
+                    record["cog_key"],
+                    record["checksum"],
+                    record["seconds"],
+                )
+                cogs_done += 1
+                unit_seconds += record["seconds"]
+                s3_gets += record["s3_gets"]
+            for future in done:
+                source, start, stop = pending.pop(future)
+                prefix, key, etag = source
+                remaining[key] -= 1
+                try:
+                    count = future.result()
+                except Exception as err:
+                    print(f"Failed: {key} from time step {start}: {err}", flush=True)
+                    failed.add(key)
+                    continue
+                units_done += (count if stop is None else min(stop, count)) - start
+                if start == 0 and steps_per_task:
+                    # Fan out one task per steps_per_task later time steps
+                    for first in range(steps_per_task, count, steps_per_task):
+                        submit(source, first, first + steps_per_task)
+                if not remaining[key] and key not in failed:
+                    manifest.complete(key, etag)
+
+            if time.time() - last_report > report_every or not pending:
+                last_report = time.time()
+                elapsed = max(last_report - start_time, 1e-6)
+                print(
+                    f"{units_done} time steps, {cogs_done} COGs in {elapsed:.0f} s: "
+                    f"{units_done / elapsed:.2f} time steps/s, "
+                    f"{cogs_done / elapsed:.2f} COGs/s, "
+                    f"{unit_seconds / max(units_done, 1):.1f} s per time step per worker, "
+                    f"{s3_gets / max(cogs_done, 1):.1f} S3 GETs per COG",
+                    flush=True,
+                )
+    if failed:
+        print(f"{len(failed)} source files failed, rerun to retry them")
+    return cogs_done
@@ -0,0 +1,123 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from boto3.s3.transfer import TransferConfig
+from rasterio.io import MemoryFile
+from xarray import DataArray
+
+COG_PROFILE = {"driver": "COG", "compress": "DEFLATE", "overviews": "AUTO"}
+
+# Multipart upload in 16 MB parts, sent over a few connections per COG
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+
+def encode_cog(data: DataArray, **profile) -> bytes:
+    """Encode ``data`` as a COG in memory and return its bytes.
+
+    The GDAL COG driver writes the overviews in the same pass. ``profile``
+    overrides ``COG_PROFILE``, e.g. ``overview_count=4`` and
+    ``overview_resampling="average"`` for what ``cog_translate`` used to add.
+    """
+    with MemoryFile() as memfile:
+        data.rio.to_raster(memfile.name, **{**COG_PROFILE, **profile})
+        return memfile.read()
+
+
+class CogWriter:
+    """Write the ``Dict[str, DataArray]`` returned by a plugin to S3 as COGs.
+
+    Each array is encoded once, in memory, by the calling thread and handed to
+    a thread pool that uploads it while the next array is being encoded. At
+    most ``max_pending`` encoded COGs wait for their upload, which bounds the
+    memory used. Use it as a context manager, leaving the block waits for the
+    uploads and raises the first upload error.
+
+        with CogWriter(s3_client, bucket, prefix) as writer:
+            writer.write_all(plugin(file_obj, name, nodata))
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket,
+        prefix="",
+        max_pending=4,
+        transfer_config=TRANSFER_CONFIG,
+        **profile,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.transfer_config = transfer_config
+        self.profile = profile
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(max_pending)
+        self._uploads = []
+
+    def key(self, cog_filename):
+        """S3 key ``cog_filename`` is written to."""
+        return f"{self.prefix}/{cog_filename}" if self.prefix else cog_filename
+
+    def _upload(self, body, key, on_upload):
+        try:
+            self.s3_client.upload_fileobj(
+                io.BytesIO(body), self.bucket, key, Config=self.transfer_config
+            )
+            if on_upload is not None:
+                on_upload(key, body)
+        finally:
+            self._slots.release()
+        return key
+
+    def write(self, cog_filename, data: DataArray, on_upload=None) -> str:
+        """Encode ``data`` and queue its upload, returns the S3 key.
+
+        ``on_upload(key, body)`` is called from the upload thread once the COG
+        is uploaded.
+        """
+        body = encode_cog(data, **self.profile)
+        key = self.key(cog_filename)
+
+        # Raise upload errors as soon as they happen and forget finished uploads
+        pending = []
+        for upload in self._uploads:
+            if upload.done():
+                upload.result()
+            else:
+                pending.append(upload)
+        self._uploads = pending
+
+        self._slots.acquire()
+        self._uploads.append(self._executor.submit(self._upload, body, key, on_upload))
+        return key
+
+    def write_all(self, var_data: Dict[str, DataArray]) -> List[str]:
+        """Write every COG of a plugin output dict, returns the S3 keys."""
+        return [self.write(name, data) for name, data in var_data.items()]
+
+    def flush(self):
+        """Wait for the queued uploads, raising the first error."""
+        try:
+            for upload in self._uploads:
+                upload.result()
+        finally:
+            self._uploads = []
+
+    def close(self):
+        """Wait for the queued uploads, raising the first error."""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
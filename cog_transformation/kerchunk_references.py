@@ -0,0 +1,262 @@
+"""Kerchunk references over the raw netCDFs of a collection and over its COGs.
+
+A reference file maps the chunks of many files to one virtual Zarr store, so
+xarray opens a whole collection lazily as one (time, lat, lon) cube and a
+point or regional time series is a few range requests into the files instead
+of one open per file:
+
+    python kerchunk_references.py netcdf geos_oco2 s3://raw-bucket/geos-oco2/ \\
+        s3://ghgc-data-store-develop/geos-oco2/netcdf_references.json
+    python kerchunk_references.py cogs s3://ghgc-data-store-develop/geos-oco2/ \\
+        s3://ghgc-data-store-develop/geos-oco2/references
+
+    xds = open_references(
+        "s3://ghgc-data-store-develop/geos-oco2/references/"
+        "oco2_GEOS_XCO2_L3CO2_day_B10206Ar.json"
+    )
+
+The netCDF references point at the raw grids, ``normalize_grid`` of the
+plugins gives them the longitudes and latitudes of the COGs. The COGs are
+grouped by variable, one reference file per variable, and each keeps the full
+resolution of the COGs, without the overviews. Only single band COGs are
+supported, not the stacked ones, and reading them needs ``imagecodecs`` for the
+COG compression.
+"""
+
+import argparse
+import base64
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+import numpy as np
+import rasterio
+import xarray
+from kerchunk.combine import MultiZarrToZarr
+from kerchunk.hdf import SingleHdf5ToZarr
+from kerchunk.tiff import tiff_to_zarr
+
+# How the raw files of each collection are combined: the dimension they are
+# concatenated along, the dimensions they share, and for files without a time
+# coordinate the pattern of the file name giving their coordinate
+SOURCES = {
+    "geos_oco2": {"concat_dims": ["time"], "identical_dims": ["lat", "lon"]},
+    "tm5_4dvar_update_noaa": {
+        "concat_dims": ["year"],
+        "identical_dims": ["latitude", "longitude"],
+        "file_coords": {"year": r"_(\d{4})\.nc$"},
+    },
+    "ecco_darwin": {"concat_dims": ["time"], "identical_dims": ["x", "y"]},
+    "lpjwsl": {"concat_dims": ["time"], "identical_dims": ["latitude", "longitude"]},
+}
+
+# Date of a COG, from the end of its file name: YYYY, YYYYMM or YYYYMMDD
+COG_DATE = re.compile(r"_(\d{4})(\d{2})?(\d{2})?\.tif$")
+
+# Variable of the full resolution COG in the references
+COG_VAR = "data"
+
+# Bytes of chunks kept inline in the references, instead of a range request
+INLINE_THRESHOLD = 300
+
+
+def netcdf_references(url, storage_options=None):
+    """Kerchunk references of one netCDF4/HDF5 file."""
+    with fsspec.open(url, "rb", **(storage_options or {})) as fp:
+        return SingleHdf5ToZarr(fp, url, inline_threshold=INLINE_THRESHOLD).translate()
+
+
+def _coordinate(name, values):
+    """References of a coordinate array held inline."""
+    values = np.asarray(values, dtype="<f8")
+    zarray = {
+        "chunks": [len(values)],
+        "compressor": None,
+        "dtype": "<f8",
+        "fill_value": None,
+        "filters": None,
+        "order": "C",
+        "shape": [len(values)],
+        "zarr_format": 2,
+    }
+    return {
+        f"{name}/.zarray": json.dumps(zarray),
+        f"{name}/.zattrs": json.dumps({"_ARRAY_DIMENSIONS": [name]}),
+        f"{name}/0": "base64:" + base64.b64encode(values.tobytes()).decode(),
+    }
+
+
+def cog_references(url, storage_options=None):
+    """Kerchunk references of the full resolution of one COG.
+
+    The image is the ``data`` variable, on the ``lat`` and ``lon`` of the
+    pixel centers and with the nodata of the COG as fill value. Stacked COGs
+    hold their time steps as bands, which a reference along ``time`` cannot
+    express, and raise a ``ValueError``.
+    """
+    refs = tiff_to_zarr(url, remote_options=storage_options)
+    refs = refs.get("refs", refs)
+    # With overviews the full resolution is the first level of a multiscale group
+    level = "0/" if "0/.zarray" in refs else ""
+    out = {".zgroup": json.dumps({"zarr_format": 2})}
+    for key, value in refs.items():
+        name = key[len(level) :]
+        if key.startswith(level) and "/" not in name and name != ".zgroup":
+            out[f"{COG_VAR}/{name}"] = value
+    zarray = json.loads(out[f"{COG_VAR}/.zarray"])
+
+    with fsspec.open(url, "rb", **(storage_options or {})) as fp:
+        with rasterio.open(fp) as src:
+            transform, nodata = src.transform, src.nodata
+            height, width = src.height, src.width
+            if src.count > 1:
+                raise ValueError(f"{url} has {src.count} bands, use single band COGs")
+    zarray["fill_value"] = nodata
+    out[f"{COG_VAR}/.zarray"] = json.dumps(zarray)
+    out[f"{COG_VAR}/.zattrs"] = json.dumps({"_ARRAY_DIMENSIONS": ["lat", "lon"]})
+    out.update(_coordinate("lon", transform.c + transform.a * (np.arange(width) + 0.5)))
+    out.update(
+        _coordinate("lat", transform.f + transform.e * (np.arange(height) + 0.5))
+    )
+    return {"version": 1, "refs": out}
+
+
+def cog_datetime(url):
+    """Date of a COG from its file name, e.g. ``..._202001.tif``."""
+    year, month, day = COG_DATE.search(url).groups()
+    return np.datetime64(f"{year}-{month or '01'}-{day or '01'}", "s")
+
+
+def group_cogs(urls):
+    """``urls`` of COGs grouped by file name without the date, e.g. by variable."""
+    groups = {}
+    for url in urls:
+        groups.setdefault(COG_DATE.sub("", url.rsplit("/", 1)[-1]), []).append(url)
+    return groups
+
+
+def _references(func, urls, storage_options, workers):
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(lambda url: func(url, storage_options), urls))
+
+
+def combine_netcdf_references(collection, urls, storage_options=None, workers=8):
+    """References of the raw netCDFs ``urls`` of ``collection`` as one store."""
+    source = SOURCES[collection]
+    coo_map = {"time": "cf:time"}
+    coo_dtypes = {}
+    for dim, pattern in source.get("file_coords", {}).items():
+        coo_map[dim] = [int(re.search(pattern, url).group(1)) for url in urls]
+        coo_dtypes[dim] = "i4"
+    return MultiZarrToZarr(
+        _references(netcdf_references, urls, storage_options, workers),
+        concat_dims=source["concat_dims"],
+        identical_dims=source["identical_dims"],
+        coo_map={dim: coo_map[dim] for dim in source["concat_dims"]},
+        coo_dtypes=coo_dtypes,
+        remote_protocol="s3",
+        remote_options=storage_options,
+    ).translate()
+
+
+def combine_cog_references(urls, storage_options=None, workers=8):
+    """References of the COGs ``urls`` as one store along ``time``.
+
+    The COGs must share their grid, the time of each is the date at the end
+    of its file name.
+    """
+    return MultiZarrToZarr(
+        _references(cog_references, urls, storage_options, workers),
+        concat_dims=["time"],
+        identical_dims=["lat", "lon"],
+        coo_map={"time": [cog_datetime(url) for url in urls]},
+        coo_dtypes={"time": "M8[s]"},
+        remote_protocol="s3",
+        remote_options=storage_options,
+    ).translate()
+
+
+def write_references(refs, url, storage_options=None):
+    """Write the references ``refs`` as JSON to ``url``."""
+    with fsspec.open(url, "w", **(storage_options or {})) as fp:
+        json.dump(refs, fp)
+
+
+def write_cog_references(urls, target, storage_options=None, workers=8):
+    """Write the references of the COGs ``urls``, one file per ``group_cogs`` group.
+
+    The COGs of different variables share their dates, so each variable is
+    combined on its own into ``<target>/<group>.json``. Returns the URLs of
+    the reference files.
+    """
+    written = []
+    for name, group in group_cogs(urls).items():
+        refs = combine_cog_references(group, storage_options, workers)
+        write_references(refs, f"{target}/{name}.json", storage_options)
+        written.append(f"{target}/{name}.json")
+    return written
+
+
+def open_references(url, storage_options=None, chunks=None):
+    """Dataset of a reference file, read lazily from the referenced files."""
+    try:
+        # The chunks of the COG references are compressed with these codecs
+        from imagecodecs.numcodecs import register_codecs
+    except ImportError:
+        pass
+    else:
+        register_codecs()
+    return xarray.open_dataset(
+        "reference://",
+        engine="zarr",
+        chunks=chunks,
+        backend_kwargs={
+            "consolidated": False,
+            "storage_options": {
+                "fo": url,
+                "target_options": storage_options or {},
+                "remote_protocol": "s3",
+                "remote_options": storage_options or {},
+            },
+        },
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="kind", required=True)
+    netcdf = subparsers.add_parser("netcdf")
+    netcdf.add_argument("collection", choices=sorted(SOURCES))
+    netcdf.add_argument("source", help="S3 prefix of the raw files")
+    netcdf.add_argument("target", help="reference file written")
+    netcdf.add_argument("--suffix", default=".nc")
+    cogs = subparsers.add_parser("cogs")
+    cogs.add_argument("source", help="S3 prefix of the COGs")
+    cogs.add_argument(
+        "target", help="prefix of the reference files written, one per variable"
+    )
+    cogs.add_argument("--match", default="", help="pattern of the COGs to include")
+    for subparser in (netcdf, cogs):
+        subparser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    fs = fsspec.filesystem("s3")
+    if args.kind == "netcdf":
+        suffix, match = args.suffix, ""
+    else:
+        suffix, match = ".tif", args.match
+    urls = [
+        f"s3://{path}"
+        for path in sorted(fs.find(args.source))
+        if path.endswith(suffix) and re.search(match, path)
+    ]
+    if args.kind == "netcdf":
+        refs = combine_netcdf_references(args.collection, urls, workers=args.workers)
+        write_references(refs, args.target)
+        targets = [args.target]
+    else:
+        targets = write_cog_references(
+            urls, args.target.rstrip("/"), workers=args.workers
+        )
+    print(f"References of {len(urls)} files written to {', '.join(targets)}")
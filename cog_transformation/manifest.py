@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+
+class Manifest:
+    """Append-only JSON lines record of the COGs converted from source files.
+
+    Every COG gets a line once it is uploaded, and every source file gets a
+    ``complete`` line once all its COGs are, each written and flushed to disk
+    straight away. Reading the manifest back on a rerun tells which source
+    files can be skipped without opening them and which COGs of a partly
+    converted file are already there. A changed ETag makes a source file
+    count as not converted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._converted = set()
+        self._complete = set()
+        self.records = []
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "rb+") as fp:
+                content = fp.read()
+                # A line cut short by a crash is dropped, it was being written
+                fp.truncate(content.rfind(b"\n") + 1)
+            for line in content.splitlines(keepends=True):
+                if line.endswith(b"\n"):
+                    self._add(json.loads(line))
+        self._file = open(path, "a")
+
+    def _add(self, record):
+        source = (record["source_key"], record["etag"])
+        if record.get("complete"):
+            self._complete.add(source)
+        else:
+            self._converted.add((*source, record["time"], record["var"]))
+            self.records.append(record)
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._add(record)
+
+    def is_complete(self, source_key, etag):
+        """Whether all COGs of the source file were converted."""
+        return (source_key, etag) in self._complete
+
+    def converted(self, source_key, etag):
+        """``(time, var)`` of the COGs of the source file already converted.
+
+        The conversion tasks skip these COGs.
+        """
+        return {
+            (time, var)
+            for key, tag, time, var in self._converted
+            if (key, tag) == (source_key, etag)
+        }
+
+    def add_cog(self, source_key, etag, time, var, cog_key, checksum, seconds):
+        """Record a converted COG."""
+        self._write(
+            {
+                "source_key": source_key,
+                "etag": etag,
+                "time": time,
+                "var": var,
+                "cog_key": cog_key,
+                "sha256": checksum,
+                "seconds": round(seconds, 3),
+            }
+        )
+
+    def complete(self, source_key, etag):
+        """Record that all COGs of the source file were converted."""
+        self._write({"source_key": source_key, "etag": etag, "complete": True})
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
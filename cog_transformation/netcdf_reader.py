@@ -0,0 +1,135 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import xarray
+
+# Block size used to read the metadata, before the chunk layout is known
+METADATA_BLOCK_SIZE = 1024 * 1024
+
+# Bytes of blocks the block cache of a file holds at most
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def time_step_bytes(xds, time_dim="time"):
+    """Bytes of the chunks holding one time step of all variables of ``xds``.
+
+    Unchunked variables count with their whole size for one time step.
+    """
+    total = 0
+    for var in xds.data_vars.values():
+        chunks = var.encoding.get("chunksizes") or var.shape
+        sizes = dict(zip(var.dims, chunks))
+        sizes[time_dim] = 1 if time_dim in sizes else None
+        count = 1
+        for size in sizes.values():
+            count *= size or 1
+        total += count * var.dtype.itemsize
+    return total
+
+
+class CachedNetCDF:
+    """netCDF on S3 read through a block cache sized to its chunk layout.
+
+    The file stays open for as long as the reader, so the HDF5 metadata and
+    chunk index are read once. With ``block_size=None`` the file is first
+    opened with small blocks to read the chunk layout, then reopened with
+    blocks holding the chunks of one time step (clamped to ``min_block_size``
+    and ``max_block_size``), so each time step is read with few GET requests.
+    The block cache keeps at most ``max_cache_bytes`` of blocks.
+    ``time_step(i)`` returns time step ``i`` loaded in memory and, unless
+    ``prefetch=False``, starts loading ``i + 1`` in a background thread, so
+    that it is read while ``i`` is encoded. Only prefetch the time step the
+    caller reads next. ``requests`` counts the GET requests sent so far.
+    """
+
+    def __init__(
+        self,
+        fs,
+        path,
+        block_size=None,
+        cache_type="blockcache",
+        time_dim="time",
+        min_block_size=METADATA_BLOCK_SIZE,
+        max_block_size=64 * 1024 * 1024,
+        max_cache_bytes=MAX_CACHE_BYTES,
+        engine="h5netcdf",
+        preprocess=None,
+    ):
+        self.fs = fs
+        self.path = path
+        self.cache_type = cache_type
+        self.time_dim = time_dim
+        self.engine = engine
+        self.preprocess = preprocess
+        self.max_cache_bytes = max_cache_bytes
+        self.requests = 0
+        self._lock = threading.Lock()
+        if block_size is None:
+            self._open(METADATA_BLOCK_SIZE)
+            block_size = min(
+                max(time_step_bytes(self.dataset, time_dim), min_block_size),
+                max_block_size,
+            )
+            if block_size != METADATA_BLOCK_SIZE:
+                self.dataset.close()
+                self._open(block_size)
+        else:
+            self._open(block_size)
+        self.block_size = block_size
+        self._executor = ThreadPoolExecutor(1)
+        self._prefetched = {}
+
+    def _open(self, block_size):
+        cache_options = {}
+        if self.cache_type == "blockcache":
+            cache_options["maxblocks"] = max(self.max_cache_bytes // block_size, 1)
+        self.file = self.fs.open(
+            self.path,
+            block_size=block_size,
+            cache_type=self.cache_type,
+            cache_options=cache_options,
+        )
+        # Count every range request the cache sends to S3
+        fetcher = self.file.cache.fetcher
+
+        @functools.wraps(fetcher)
+        def counted_fetcher(start, end):
+            with self._lock:
+                self.requests += 1
+            return fetcher(start, end)
+
+        self.file.cache.fetcher = counted_fetcher
+        self.dataset = xarray.open_dataset(self.file, engine=self.engine)
+        if self.preprocess is not None:
+            self.dataset = self.preprocess(self.dataset)
+
+    def __len__(self):
+        return self.dataset.sizes[self.time_dim]
+
+    def _load(self, index):
+        return self.dataset.isel({self.time_dim: index}).load()
+
+    def time_step(self, index, prefetch=True):
+        """Time step ``index`` loaded in memory, prefetching the next one."""
+        future = self._prefetched.pop(index, None)
+        data = future.result() if future is not None else self._load(index)
+        # A time step prefetched but not read is dropped
+        for future in self._prefetched.values():
+            future.cancel()
+        self._prefetched = {}
+        if prefetch and index + 1 < len(self):
+            self._prefetched[index + 1] = self._executor.submit(self._load, index + 1)
+        return data
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+        self._prefetched = {}
+        self.dataset.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
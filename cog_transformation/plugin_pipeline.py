@@ -0,0 +1,349 @@
+"""Run a transformation plugin over many raw files as a pipeline.
+
+The DAG calls ``plugin(file_obj, name, nodata) -> Dict[str, DataArray]`` one
+file at a time. Here the same plugins run as four stages connected by bounded
+queues, each stage with its own workers, so that downloading, transforming,
+encoding and uploading of different files overlap:
+
+- download: reads the raw files from S3 with s3fs
+- transform: runs the plugin in a process pool
+- stack (optional): packs the stacked outputs of all files into multi-band
+  COGs, see ``time_stacking``
+- encode: encodes the COGs in threads, GDAL releases the GIL while encoding
+- upload: multipart uploads of the encoded COGs to S3
+
+    python plugin_pipeline.py geos_oco2 s3://raw-bucket/geos-oco2/ \\
+        ghgc-data-store-develop geos-oco2 --transform-workers 4
+"""
+
+import argparse
+import functools
+import importlib
+import io
+import multiprocessing
+import pathlib
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List
+
+import boto3
+import s3fs
+from xarray import DataArray
+
+from cog_writer import TRANSFER_CONFIG, encode_cog
+from time_stacking import stack_files, year_group
+
+# Marks the end of the items of a queue
+_DONE = object()
+
+
+def _transform(plugin, body, name, nodata):
+    """Run ``plugin`` on the raw file ``body`` in a worker process.
+
+    The arrays are loaded before they are sent back, so only the slices
+    written to the COGs are pickled and not a handle on the raw file. Their
+    spatial dimensions are sent along, rioxarray does not pickle them.
+    """
+    var_data = plugin(io.BytesIO(body), name, nodata)
+    return {
+        cog_filename: (data.load(), data.rio.x_dim, data.rio.y_dim)
+        for cog_filename, data in var_data.items()
+    }
+
+
+class Stage:
+    """Workers taking items from ``inbox``, each item giving zero or more outputs."""
+
+    def __init__(self, name, func, workers, inbox):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = inbox
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def run(self, outbox, failures):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                # Leave the marker for the other workers of the stage
+                self.inbox.put(_DONE)
+                return
+            start_time = time.perf_counter()
+            try:
+                outputs = list(self.func(item))
+            except Exception as err:
+                name = item if isinstance(item, str) else item[0]
+                failures.append((self.name, name, err))
+                outputs = []
+            with self._lock:
+                self.items += 1
+                self.busy += time.perf_counter() - start_time
+            for output in outputs:
+                outbox.put(output)
+
+
+class StackStage(Stage):
+    """Stage holding all its items and packing them into stacks at the end.
+
+    The stacked outputs of every file are grouped by ``group(cog_filename)``
+    and the bands of each group concatenated by ``time_stacking.stack_files``,
+    so the daily files of a year give one COG per variable.
+    """
+
+    def __init__(self, name, group, inbox):
+        super().__init__(name, None, 1, inbox)
+        self.group = group
+
+    def run(self, outbox, failures):
+        var_data = {}
+        for cog_filename, data in iter(self.inbox.get, _DONE):
+            var_data[cog_filename] = data
+            with self._lock:
+                self.items += 1
+        self.inbox.put(_DONE)
+        start_time = time.perf_counter()
+        groups = {}
+        for cog_filename, data in var_data.items():
+            groups.setdefault(self.group(cog_filename), {})[cog_filename] = data
+        for name, group_data in groups.items():
+            try:
+                outputs = stack_files([group_data], self.group)
+            except Exception as err:
+                failures.append((self.name, name, err))
+                outputs = {}
+            for output in outputs.items():
+                outbox.put(output)
+        with self._lock:
+            self.busy += time.perf_counter() - start_time
+
+
+class PluginPipeline:
+    """Transform raw files with ``plugin`` and write the COGs to S3.
+
+    ``queue_size`` bounds the number of items waiting in front of each stage,
+    which bounds the raw files and COGs held in memory. A file failing in any
+    stage is reported in ``failures`` and the other files carry on.
+
+    With ``stack_group``, the plugin must return stacked arrays (e.g.
+    ``functools.partial(plugin, stacked=True)``) and the outputs of all files
+    are packed into one multi-band COG per ``stack_group(cog_filename)``
+    before they are encoded. The arrays of all files are then held in memory
+    until the last file is transformed, run the pipeline on a year of files
+    at a time.
+    """
+
+    def __init__(
+        self,
+        plugin: Callable[..., Dict[str, DataArray]],
+        fs,
+        s3_client,
+        bucket,
+        prefix="",
+        nodata=-9999,
+        download_workers=4,
+        transform_workers=2,
+        encode_workers=4,
+        upload_workers=4,
+        queue_size=8,
+        stack_group=None,
+        **profile,
+    ):
+        self.plugin = plugin
+        self.fs = fs
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.nodata = nodata
+        self.transform_workers = transform_workers
+        self.profile = profile
+        self.stages = [
+            Stage(
+                "download", self._download, download_workers, queue.Queue(queue_size)
+            ),
+            Stage(
+                "transform", self._transform, transform_workers, queue.Queue(queue_size)
+            ),
+            Stage("encode", self._encode, encode_workers, queue.Queue(queue_size)),
+            Stage("upload", self._upload, upload_workers, queue.Queue(queue_size)),
+        ]
+        if stack_group is not None:
+            self.stages.insert(
+                2, StackStage("stack", stack_group, queue.Queue(queue_size))
+            )
+        self.failures = []
+        self._processes = None
+        self._start_time = None
+
+    def _download(self, path):
+        yield path, self.fs.cat_file(path)
+
+    def _transform(self, item):
+        path, body = item
+        # The plugins name the COGs after the file name, as in the DAG
+        name = path.rsplit("/", 1)[-1]
+        future = self._processes.submit(
+            _transform, self.plugin, body, name, self.nodata
+        )
+        for cog_filename, (data, x_dim, y_dim) in future.result().items():
+            data.rio.set_spatial_dims(x_dim, y_dim, inplace=True)
+            yield cog_filename, data
+
+    def _encode(self, item):
+        cog_filename, data = item
+        yield cog_filename, encode_cog(data, **self.profile)
+
+    def _upload(self, item):
+        cog_filename, body = item
+        key = f"{self.prefix}/{cog_filename}" if self.prefix else cog_filename
+        self.s3_client.upload_fileobj(
+            io.BytesIO(body), self.bucket, key, Config=TRANSFER_CONFIG
+        )
+        yield key
+
+    def report(self) -> str:
+        """Items done, throughput, busy workers and queue depth of every stage."""
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        lines = [f"{'stage':10}{'items':>8}{'items/s':>9}{'busy':>7}{'queued':>8}"]
+        for stage in self.stages:
+            rate = stage.items / elapsed if elapsed else 0.0
+            busy = stage.busy / elapsed if elapsed else 0.0
+            lines.append(
+                f"{stage.name:10}{stage.items:8d}{rate:9.2f}"
+                f"{busy:5.1f}/{stage.workers:<2d}{stage.inbox.qsize():7d}"
+            )
+        return "\n".join(lines)
+
+    def run(self, paths, report_every=60) -> List[str]:
+        """Process ``paths`` and return the S3 keys of the COGs written.
+
+        The stage report is printed every ``report_every`` seconds and at the
+        end; pass ``report_every=None`` for the final report only.
+        """
+        self._start_time = time.perf_counter()
+        self.failures = []
+        keys = queue.Queue()
+        outboxes = [stage.inbox for stage in self.stages[1:]] + [keys]
+        finished = threading.Event()
+
+        def monitor():
+            while not finished.wait(report_every):
+                print(self.report(), flush=True)
+
+        # Spawned, not forked, as the stage threads are already running
+        self._processes = ProcessPoolExecutor(
+            self.transform_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        with self._processes:
+            threads = [
+                [
+                    threading.Thread(
+                        target=stage.run, args=(outbox, self.failures), daemon=True
+                    )
+                    for _ in range(stage.workers)
+                ]
+                for stage, outbox in zip(self.stages, outboxes)
+            ]
+            for stage_threads in threads:
+                for thread in stage_threads:
+                    thread.start()
+            if report_every:
+                threading.Thread(target=monitor, daemon=True).start()
+
+            inbox = self.stages[0].inbox
+            for path in paths:
+                inbox.put(path)
+            inbox.put(_DONE)
+            # A stage is done once all its workers are, then the next one
+            # gets the end marker
+            for stage, stage_threads, outbox in zip(self.stages, threads, outboxes):
+                for thread in stage_threads:
+                    thread.join()
+                stage.inbox.get_nowait()
+                outbox.put(_DONE)
+
+        finished.set()
+        print(self.report(), flush=True)
+        return list(iter(keys.get_nowait, _DONE))
+
+
+def load_plugin(collection):
+    """The ``<collection>_transformation`` function of ``data_transformation_plugins``."""
+    sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+    module = importlib.import_module(
+        f"data_transformation_plugins.{collection}_transformation"
+    )
+    return getattr(module, f"{collection}_transformation")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("collection", help="e.g. geos_oco2 or tm5_4dvar_update_noaa")
+    parser.add_argument(
+        "source", help="S3 prefix of the raw files, s3://bucket/prefix/"
+    )
+    parser.add_argument("bucket")
+    parser.add_argument("prefix")
+    parser.add_argument("--suffix", default=".nc")
+    parser.add_argument("--nodata", type=float, default=-9999)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--transform-workers", type=int, default=2)
+    parser.add_argument("--encode-workers", type=int, default=4)
+    parser.add_argument("--upload-workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--report-every", type=float, default=60)
+    parser.add_argument(
+        "--stacked",
+        action="store_true",
+        help="one multi-band COG per variable and year, a band per time step",
+    )
+    parser.add_argument(
+        "--references",
+        action="store_true",
+        help="also write Kerchunk references of the raw files and of the COGs",
+    )
+    args = parser.parse_args()
+
+    fs = s3fs.S3FileSystem()
+    paths = sorted(path for path in fs.find(args.source) if path.endswith(args.suffix))
+    plugin = load_plugin(args.collection)
+    if args.stacked:
+        plugin = functools.partial(plugin, stacked=True)
+    pipeline = PluginPipeline(
+        plugin,
+        fs,
+        boto3.client("s3"),
+        args.bucket,
+        args.prefix,
+        nodata=args.nodata,
+        download_workers=args.download_workers,
+        transform_workers=args.transform_workers,
+        encode_workers=args.encode_workers,
+        upload_workers=args.upload_workers,
+        queue_size=args.queue_size,
+        stack_group=year_group if args.stacked else None,
+    )
+    keys = pipeline.run(paths, report_every=args.report_every)
+    print(f"{len(keys)} COGs written from {len(paths)} files")
+    for stage, name, err in pipeline.failures:
+        print(f"Failed in {stage}: {name}: {err}")
+
+    if args.references:
+        import kerchunk_references
+
+        target = f"s3://{args.bucket}/{args.prefix}/references"
+        if args.collection in kerchunk_references.SOURCES:
+            refs = kerchunk_references.combine_netcdf_references(
+                args.collection, [f"s3://{path}" for path in paths]
+            )
+            kerchunk_references.write_references(refs, f"{target}/netcdf.json")
+        if args.stacked:
+            print("No references of the stacked COGs, their bands are time steps")
+        else:
+            cogs = [f"s3://{args.bucket}/{key}" for key in keys]
+            kerchunk_references.write_cog_references(cogs, target)
+        print(f"References written to {target}/")
@@ -0,0 +1,89 @@
+"""The stacked mode of the pipeline on a few synthetic daily GEOS-OCO2 files.
+
+python -m pytest cog_transformation/test_plugin_pipeline.py
+"""
+
+import functools
+import io
+
+import numpy as np
+import pytest
+
+pd = pytest.importorskip("pandas")
+xarray = pytest.importorskip("xarray")
+pytest.importorskip("h5netcdf")
+pytest.importorskip("rioxarray")
+pytest.importorskip("s3fs")
+rasterio = pytest.importorskip("rasterio")
+from rasterio.io import MemoryFile
+
+from plugin_pipeline import PluginPipeline, load_plugin
+from time_stacking import year_group
+
+DAYS = pd.date_range("2020-01-01", periods=3, freq="D")
+
+
+def daily_file(day):
+    """netCDF bytes of one day on a 0 to 360, south to north grid."""
+    xds = xarray.Dataset(
+        {
+            var: (("time", "lat", "lon"), np.full((1, 4, 8), value, "float32"))
+            for var, value in (("XCO2", day.day), ("XCO2PREC", -day.day))
+        },
+        coords={
+            "time": [day],
+            "lat": np.linspace(-67.5, 67.5, 4),
+            "lon": np.arange(0, 360, 45.0),
+        },
+    )
+    return bytes(xds.to_netcdf(engine="h5netcdf"))
+
+
+class FakeFileSystem:
+    def __init__(self, files):
+        self.files = files
+
+    def cat_file(self, path):
+        return self.files[path]
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        self.objects[key] = fileobj.read()
+
+
+def test_stacked_daily_files_give_one_cog_per_variable():
+    files = {
+        f"raw/oco2_GEOS_L3CO2_day_{day:%Y%m%d}_B10206Ar.nc4": daily_file(day)
+        for day in DAYS
+    }
+    s3_client = FakeS3Client()
+    pipeline = PluginPipeline(
+        functools.partial(load_plugin("geos_oco2"), stacked=True),
+        FakeFileSystem(files),
+        s3_client,
+        "bucket",
+        "geos-oco2",
+        stack_group=year_group,
+    )
+    keys = pipeline.run(sorted(files), report_every=None)
+
+    assert not pipeline.failures
+    assert sorted(keys) == [
+        "geos-oco2/oco2_GEOS_XCO2PREC_L3CO2_day_B10206Ar_2020.tif",
+        "geos-oco2/oco2_GEOS_XCO2_L3CO2_day_B10206Ar_2020.tif",
+    ]
+    assert sorted(s3_client.objects) == sorted(keys)
+    for key in keys:
+        with MemoryFile(io.BytesIO(s3_client.objects[key])) as memfile:
+            with memfile.open() as src:
+                assert src.count == len(DAYS)
+                assert src.descriptions == tuple(
+                    f"{day:%Y-%m-%d}T00:00:00Z" for day in DAYS
+                )
+                sign = -1 if "XCO2PREC" in key else 1
+                for band, day in enumerate(DAYS, start=1):
+                    assert np.all(src.read(band) == sign * day.day)
@@ -0,0 +1,86 @@
+"""Multi-band COGs with one band per time step, and their STAC band index.
+
+The plugins return, with ``stacked=True``, one array per variable with the
+time steps of a file as bands. They are single files for the DAG, so each
+defines the same ``stack_time`` as here. ``stack_files`` packs the stacks of
+many files into one, e.g. the daily GEOS-OCO2 files of a year.
+"""
+
+import re
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Sequence
+
+import numpy as np
+import xarray
+from xarray import DataArray
+
+DATETIME_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Date at the end of a COG file name, YYYYMM or YYYYMMDD
+_FILENAME_DATE = re.compile(r"_(\d{4})\d{2}(\d{2})?\.tif$")
+
+
+def stack_time(
+    data: DataArray, datetimes: Sequence[str], time_dim: str = "time"
+) -> DataArray:
+    """``data`` with its time steps as bands, band ``i`` at ``datetimes[i - 1]``.
+
+    The datetimes are kept as the band descriptions and as the ``datetimes``
+    tag of the COG, which ``band_index`` reads back.
+    """
+    if time_dim != "band":
+        data = data.rename({time_dim: "band"})
+    data = data.transpose("band", ...)
+    data = data.assign_coords(band=np.arange(1, len(datetimes) + 1))
+    data.attrs["long_name"] = tuple(datetimes)
+    data.attrs["datetimes"] = ",".join(datetimes)
+    return data
+
+
+def concat_bands(stacks: Sequence[DataArray]) -> DataArray:
+    """One stack with the bands of ``stacks``, in the order of their datetimes."""
+    datetimes = [dt for data in stacks for dt in data.attrs["datetimes"].split(",")]
+    data = xarray.concat(stacks, dim="band", combine_attrs="override")
+    order = np.argsort(datetimes, kind="stable")
+    data = data.isel(band=order)
+    data.rio.set_spatial_dims(stacks[0].rio.x_dim, stacks[0].rio.y_dim, inplace=True)
+    data.rio.write_crs(stacks[0].rio.crs, inplace=True)
+    return stack_time(data, [datetimes[i] for i in order], time_dim="band")
+
+
+def stack_files(
+    var_datas: Iterable[Dict[str, DataArray]], group: Callable[[str], str]
+) -> Dict[str, DataArray]:
+    """Stacks of the plugin outputs of many files, one per ``group(cog_filename)``.
+
+    e.g. a year of daily stacks into one stack per variable, with ``group``
+    replacing the date in the COG filename by the year.
+    """
+    groups = defaultdict(list)
+    for var_data in var_datas:
+        for cog_filename, data in var_data.items():
+            groups[group(cog_filename)].append(data)
+    return {name: concat_bands(stacks) for name, stacks in groups.items()}
+
+
+def year_group(cog_filename: str) -> str:
+    """``cog_filename`` with its date replaced by the year, for ``stack_files``."""
+    return _FILENAME_DATE.sub(r"_\1.tif", cog_filename)
+
+
+def band_index(data: DataArray) -> Dict:
+    """STAC item properties mapping the bands of a stacked COG to their datetimes.
+
+    Works on the arrays returned by the plugins and on the COGs opened with
+    ``rioxarray.open_rasterio``.
+    """
+    datetimes = data.attrs["datetimes"].split(",")
+    return {
+        "datetime": None,
+        "start_datetime": min(datetimes),
+        "end_datetime": max(datetimes),
+        "eo:bands": [
+            {"name": f"b{band}", "description": dt}
+            for band, dt in enumerate(datetimes, start=1)
+        ],
+    }
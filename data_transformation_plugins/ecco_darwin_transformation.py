@@ -1,13 +1,64 @@
 import re
 from typing import Dict
 
+import numpy as np
 import xarray
 from s3fs import S3File
 from xarray import DataArray
 
+# Chunks of the lazy mode, the chunks of the netCDF file
+CHUNKS = {}
+
+
+def wrap_longitude(lon):
+    """Longitudes from 0 to 360 as longitudes from -180 to 180."""
+    return ((lon + 180) % 360) - 180
+
+
+def roll_longitude(xds: xarray.Dataset, lon: str = "lon") -> xarray.Dataset:
+    """Longitudes of ``xds`` wrapped to -180 to 180, in ascending order.
+
+    On a regular grid the wrapped longitudes are the ascending longitudes
+    rotated, so all variables are rolled by the same number of columns (a
+    single copy, nothing at all when the grid is already in order) instead of
+    a sort and gather per variable. Other grids fall back to sorting.
+    """
+    wrapped = wrap_longitude(xds[lon].values)
+    shift = -int(np.argmin(wrapped))
+    rolled = np.roll(wrapped, shift)
+    if np.any(np.diff(rolled) <= 0):
+        return xds.assign_coords({lon: wrapped}).sortby(lon)
+    if shift:
+        xds = xds.roll({lon: shift}, roll_coords=True)
+    return xds.assign_coords({lon: rolled})
+
+
+def flip_latitude(xds: xarray.Dataset, lat: str = "lat") -> xarray.Dataset:
+    """``xds`` with the latitudes from north to south, as written to the COGs.
+
+    Ascending latitudes are reversed with a negative step slice, which is a
+    view of the data rather than a copy.
+    """
+    values = xds[lat].values
+    if values.size > 1 and values[0] < values[-1]:
+        xds = xds.isel({lat: slice(None, None, -1)})
+    return xds
+
+
+def normalize_grid(
+    xds: xarray.Dataset, lon: str = "lon", lat: str = "lat"
+) -> xarray.Dataset:
+    """``xds`` on -180 to 180 ascending longitudes and north to south latitudes.
+
+    The layout is read from the coordinates once and applied to all the
+    variables of the dataset, call it on the dataset before selecting
+    variables or time steps.
+    """
+    return flip_latitude(roll_longitude(xds, lon), lat)
+
 
 def ecco_darwin_transformation(
-    file_obj: S3File, name: str, nodata: int
+    file_obj: S3File, name: str, nodata: int, lazy: bool = False
 ) -> Dict[str, DataArray]:
     """Transformation function for the ecco darwin dataset
 
@@ -15,19 +66,21 @@ def ecco_darwin_transformation(
         file_obj (s3fs object): s3fs sile object for one file of the dataset
         name (str): name of the file to be transformed
         nodata (int): Nodata value as specified by the data provider
+        lazy (bool): Open the file in dask chunks, the longitude roll, latitude
+            flip and nodata replacement then only run on a slice when its COG
+            is written, so one slice is in memory at a time
 
     Returns:
         dict: Dictionary with the COG name and its corresponding data array.
     """
     var_data_netcdf = {}
-    xds = xarray.open_dataset(file_obj)
+    xds = xarray.open_dataset(file_obj, chunks=CHUNKS if lazy else None)
     xds = xds.rename({"y": "latitude", "x": "longitude"})
     xds = xds.assign_coords(
-        longitude=((xds.longitude / 1440) * 360) - 180
-    ).sortby("longitude")
-    xds = xds.assign_coords(latitude=((xds.latitude / 721) * 180) - 90).sortby(
-        "latitude"
+        longitude=((xds.longitude / 1440) * 360) - 180,
+        latitude=((xds.latitude / 721) * 180) - 90,
     )
+    xds = normalize_grid(xds, "longitude", "latitude")
 
     variables = list(xds.data_vars)[2:]
 
@@ -36,7 +89,6 @@ def ecco_darwin_transformation(
         filename_elements = re.split("[_ .]", filename)
         data = xds[var]
 
-        data = data.reindex(latitude=list(reversed(data.latitude)))
         data = data.where(data != nodata, -9999)
         data.rio.set_spatial_dims("longitude", "latitude", inplace=True)
         data.rio.write_crs("epsg:4326", inplace=True)
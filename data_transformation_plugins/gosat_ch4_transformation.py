@@ -5,9 +5,24 @@ import xarray
 from s3fs import S3File
 from xarray import DataArray
 
+# Chunks of the lazy mode, the chunks of the netCDF file
+CHUNKS = {}
+
+
+def flip_latitude(xds: xarray.Dataset, lat: str = "lat") -> xarray.Dataset:
+    """``xds`` with the latitudes from north to south, as written to the COGs.
+
+    Ascending latitudes are reversed with a negative step slice, which is a
+    view of the data rather than a copy.
+    """
+    values = xds[lat].values
+    if values.size > 1 and values[0] < values[-1]:
+        xds = xds.isel({lat: slice(None, None, -1)})
+    return xds
+
 
 def gosat_ch4_transformation(
-    file_obj: S3File, name: str, nodata: int
+    file_obj: S3File, name: str, nodata: int, lazy: bool = False
 ) -> Dict[str, DataArray]:
     """Transformation function for the ecco darwin dataset
 
@@ -15,12 +30,16 @@ def gosat_ch4_transformation(
         file_obj (s3fs object): s3fs sile object for one file of the dataset
         name (str): name of the file to be transformed
         nodata (int): Nodata value as specified by the data provider
+        lazy (bool): Open the file in dask chunks, the latitude flip and
+            nodata replacement then only run on a variable when its COG is
+            written, so one variable is in memory at a time
 
     Returns:
         dict: Dictionary with the COG name and its corresponding data array.
     """
     var_data_netcdf = {}
-    ds = xarray.open_dataset(file_obj)
+    ds = xarray.open_dataset(file_obj, chunks=CHUNKS if lazy else None)
+    ds = flip_latitude(ds)
     variable = [var for var in ds.data_vars]
 
     for var in variable:
@@ -33,7 +52,6 @@ def gosat_ch4_transformation(
         # # add extension
         cog_filename = f"{cog_filename}.tif"
 
-        data = data.reindex(lat=list(reversed(data.lat)))
         data = data.where(data != nodata, -9999)
         data.rio.write_nodata(-9999, inplace=True)
 
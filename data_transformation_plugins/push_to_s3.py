@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import boto3
@@ -5,8 +6,8 @@ import boto3
 
 def upload_files_to_s3(folder_path, bucket_name, s3_folder, exclude_files):
     """
-    Uploads all files in a folder to a specified S3 folder only if the file does not already exist in S3,
-    and excluding specified files.
+    Uploads all files in a folder to a specified S3 folder only if the file does not already exist in S3
+    or its content changed, and excluding specified files.
 
     Parameters:
     - folder_path (str): Path to the local folder containing files to upload.
@@ -26,9 +27,16 @@ def upload_files_to_s3(folder_path, bucket_name, s3_folder, exclude_files):
             s3_key = os.path.join(s3_folder, file_name)
 
             try:
-                # Check if the file already exists in S3
-                s3.head_object(Bucket=bucket_name, Key=s3_key)
-                print(f"Skipped {file_name} (already exists in S3)")
+                # Check if the file already exists in S3 with the same content,
+                # the files are uploaded in one part so the ETag is their MD5
+                etag = s3.head_object(Bucket=bucket_name, Key=s3_key)["ETag"].strip('"')
+                with open(file_path, "rb") as fp:
+                    md5 = hashlib.md5(fp.read()).hexdigest()
+                if etag == md5:
+                    print(f"Skipped {file_name} (already exists in S3)")
+                else:
+                    s3.upload_file(file_path, bucket_name, s3_key)
+                    print(f"Updated {file_name} in {s3_key}")
             except s3.exceptions.ClientError as e:
                 # If the file does not exist, upload it
                 if e.response["Error"]["Code"] == "404":
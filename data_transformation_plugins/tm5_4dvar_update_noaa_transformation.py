@@ -2,13 +2,85 @@ import re
 from datetime import datetime
 from typing import Dict
 
+import numpy as np
 import xarray
 from s3fs import S3File
 from xarray import DataArray
 
+# Chunks of the lazy mode, one chunk per month
+CHUNKS = {"months": 1}
+
+
+def wrap_longitude(lon):
+    """Longitudes from 0 to 360 as longitudes from -180 to 180."""
+    return ((lon + 180) % 360) - 180
+
+
+def roll_longitude(xds: xarray.Dataset, lon: str = "lon") -> xarray.Dataset:
+    """Longitudes of ``xds`` wrapped to -180 to 180, in ascending order.
+
+    On a regular grid the wrapped longitudes are the ascending longitudes
+    rotated, so all variables are rolled by the same number of columns (a
+    single copy, nothing at all when the grid is already in order) instead of
+    a sort and gather per variable. Other grids fall back to sorting.
+    """
+    wrapped = wrap_longitude(xds[lon].values)
+    shift = -int(np.argmin(wrapped))
+    rolled = np.roll(wrapped, shift)
+    if np.any(np.diff(rolled) <= 0):
+        return xds.assign_coords({lon: wrapped}).sortby(lon)
+    if shift:
+        xds = xds.roll({lon: shift}, roll_coords=True)
+    return xds.assign_coords({lon: rolled})
+
+
+def flip_latitude(xds: xarray.Dataset, lat: str = "lat") -> xarray.Dataset:
+    """``xds`` with the latitudes from north to south, as written to the COGs.
+
+    Ascending latitudes are reversed with a negative step slice, which is a
+    view of the data rather than a copy.
+    """
+    values = xds[lat].values
+    if values.size > 1 and values[0] < values[-1]:
+        xds = xds.isel({lat: slice(None, None, -1)})
+    return xds
+
+
+def normalize_grid(
+    xds: xarray.Dataset, lon: str = "lon", lat: str = "lat"
+) -> xarray.Dataset:
+    """``xds`` on -180 to 180 ascending longitudes and north to south latitudes.
+
+    The layout is read from the coordinates once and applied to all the
+    variables of the dataset, call it on the dataset before selecting
+    variables or time steps.
+    """
+    return flip_latitude(roll_longitude(xds, lon), lat)
+
+
+# Datetimes of the bands of the stacked mode
+DATETIME_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def stack_time(data: DataArray, datetimes, time_dim: str = "time") -> DataArray:
+    """``data`` with its time steps as bands, band ``i`` at ``datetimes[i - 1]``.
+
+    The datetimes are kept as the band descriptions and as the ``datetimes``
+    tag of the COG, see ``cog_transformation/time_stacking.py``.
+    """
+    data = data.rename({time_dim: "band"}).transpose("band", ...)
+    data = data.assign_coords(band=np.arange(1, len(datetimes) + 1))
+    data.attrs["long_name"] = tuple(datetimes)
+    data.attrs["datetimes"] = ",".join(datetimes)
+    return data
+
 
 def tm5_4dvar_update_noaa_transformation(
-    file_obj: S3File, name: str, nodata: int
+    file_obj: S3File,
+    name: str,
+    nodata: int,
+    lazy: bool = False,
+    stacked: bool = False,
 ) -> Dict[str, DataArray]:
     """Transformation function for the tm5 ch4 influx dataset
 
@@ -16,34 +88,49 @@ def tm5_4dvar_update_noaa_transformation(
         file_obj (s3fs object): s3fs sile object for one file of the dataset
         name (str): name of the file to be transformed
         nodata (int): Nodata value as specified by the data provider
+        lazy (bool): Open the file in dask chunks, the longitude roll, latitude
+            flip and nodata replacement then only run on a slice when its COG
+            is written, so one slice is in memory at a time
+        stacked (bool): One COG per variable and year with the months as
+            bands, their datetimes in the band descriptions and the
+            ``datetimes`` tag
 
     Returns:
         dict: Dictionary with the COG name and its corresponding data array.
     """
 
     var_data_netcdf = {}
-    xds = xarray.open_dataset(file_obj)
+    xds = xarray.open_dataset(file_obj, chunks=CHUNKS if lazy else None)
     xds = xds.rename({"latitude": "lat", "longitude": "lon"})
-    xds = xds.assign_coords(lon=(((xds.lon + 180) % 360) - 180)).sortby("lon")
+    xds = normalize_grid(xds)
     variable = [var for var in xds.data_vars if "global" not in var]
 
-    for time_increment in range(0, len(xds.months)):
-        filename = name.split("/")[-1]
-        filename_elements = re.split("[_ .]", filename)
-        start_time = datetime(int(filename_elements[-2]), time_increment + 1, 1)
+    filename = name.split("/")[-1]
+    year = int(re.split("[_ .]", filename)[-2])
+    if stacked:
+        datetimes = [
+            datetime(year, month + 1, 1).strftime(DATETIME_FMT)
+            for month in range(len(xds.months))
+        ]
+    for time_increment in range(0, 1 if stacked else len(xds.months)):
+        start_time = datetime(year, time_increment + 1, 1)
         for var in variable:
             filename = name.split("/")[-1]
             filename_elements = re.split("[_ .]", filename)
-            data = getattr(xds.isel(months=time_increment), var)
-            data = data.isel(lat=slice(None, None, -1))
+            if stacked:
+                data = getattr(xds, var)
+            else:
+                data = getattr(xds.isel(months=time_increment), var)
             data = data.where(data != nodata, -9999)
+            if stacked:
+                data = stack_time(data, datetimes, time_dim="months")
             data.rio.set_spatial_dims("lon", "lat", inplace=True)
             data.rio.write_crs("epsg:4326", inplace=True)
             data.rio.write_nodata(-9999, inplace=True)
 
             # # insert date of generated COG into filename
             filename_elements.pop()
-            filename_elements[-1] = start_time.strftime("%Y%m")
+            filename_elements[-1] = start_time.strftime("%Y" if stacked else "%Y%m")
             filename_elements.insert(2, var)
             cog_filename = "_".join(filename_elements)
             # # add extension
@@ -0,0 +1,99 @@
+"""HTTP requests and bytes fetched per COG with and without the shared reader settings.
+
+Reads every band of the first files under an S3 prefix block by block, once
+through presigned HTTPS URLs in a default rasterio environment (how the stats
+scripts used to read) and once through ``/vsis3/`` paths in ``cog_env``.
+
+    python benchmark_cog_reads.py ghgc-data-store-dev geos-oco2/ --files 10
+"""
+
+import argparse
+import logging
+import re
+import time
+
+import boto3
+import rasterio
+from dotenv import load_dotenv
+from rasterio.session import AWSSession
+
+from block_reader import read_blocks
+from cog_env import cog_env, s3_path
+from s3_keys import list_keys
+
+# GDAL debug messages of /vsicurl/ and /vsis3/ for the requests they send
+_RANGE_REQUEST = re.compile(r"Downloading (\d+)-(\d+)")
+_OTHER_REQUEST = re.compile(r"GetFileSize\(|GetFileList\(")
+
+
+class RequestCounter(logging.Handler):
+    """Count the HTTP requests GDAL reports in its debug messages."""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.requests = 0
+        self.bytes = 0
+
+    def emit(self, record):
+        message = record.getMessage()
+        match = _RANGE_REQUEST.search(message)
+        if match:
+            self.requests += 1
+            self.bytes += int(match.group(2)) - int(match.group(1)) + 1
+        elif _OTHER_REQUEST.search(message):
+            self.requests += 1
+
+
+def measure(paths, env):
+    """Requests, bytes and seconds per file for reading ``paths`` in ``env``."""
+    counter = RequestCounter()
+    logger = logging.getLogger("rasterio")
+    logger.addHandler(counter)
+    logger.setLevel(logging.DEBUG)
+    start_time = time.time()
+    try:
+        with env:
+            for path in paths:
+                with rasterio.open(path) as src:
+                    for band in src.indexes:
+                        for _ in read_blocks(src, band):
+                            pass
+    finally:
+        logger.removeHandler(counter)
+    return (
+        counter.requests / len(paths),
+        counter.bytes / len(paths),
+        (time.time() - start_time) / len(paths),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bucket")
+    parser.add_argument("prefix")
+    parser.add_argument("--files", type=int, default=10)
+    args = parser.parse_args()
+
+    load_dotenv()
+    session = boto3.Session()
+    client = session.client("s3")
+    keys = list(list_keys(client, args.bucket, args.prefix))[: args.files]
+
+    before = measure(
+        [
+            client.generate_presigned_url(
+                "get_object", Params={"Bucket": args.bucket, "Key": key}
+            )
+            for key in keys
+        ],
+        rasterio.Env(session=AWSSession(session), CPL_DEBUG=True),
+    )
+    after = measure(
+        [s3_path(args.bucket, key) for key in keys],
+        cog_env(session, CPL_DEBUG=True),
+    )
+
+    print(f"{len(keys)} files under s3://{args.bucket}/{args.prefix}")
+    print(f"{'':8}{'requests/file':>15}{'MB/file':>10}{'s/file':>10}")
+    for name, (requests, fetched, seconds) in (("before", before), ("after", after)):
+        print(f"{name:8}{requests:15.1f}{fetched / 1e6:10.2f}{seconds:10.2f}")
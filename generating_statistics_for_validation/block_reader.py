@@ -0,0 +1,79 @@
+import numpy as np
+
+from streaming_stats import StreamingStats
+
+
+def _mask(data, nodata):
+    for value in nodata:
+        data[data == value] = np.nan
+    return data
+
+
+def read_blocks(src, band, nodata=(-9999,)):
+    """Yield ``band`` of an open rasterio dataset one internal block at a time.
+
+    The windows follow the block layout of the file (the 512x512 tiles of our
+    COGs), so only one tile is held in memory at once and every read maps to a
+    single tile request. Values equal to any of ``nodata`` are set to NaN.
+    """
+    for _, window in src.block_windows(band):
+        yield _mask(src.read(band, window=window), nodata)
+
+
+def band_minimum(src, band):
+    """Minimum of ``band`` computed block by block."""
+    return min(np.min(data) for data in read_blocks(src, band, nodata=()))
+
+
+def overview_factor(src, band, level=-1):
+    """Decimation factor of overview ``level`` of ``band``, 1 without overviews.
+
+    The default is the coarsest overview, e.g. 16 for the overviews written by
+    ``cog_translate(overview_level=4)``.
+    """
+    factors = src.overviews(band)
+    return factors[level] if factors else 1
+
+
+def _read_decimated(src, band, factor, window=None):
+    if window is None:
+        height, width = src.height, src.width
+    else:
+        height, width = window.height, window.width
+    out_shape = (max(1, round(height / factor)), max(1, round(width / factor)))
+    # GDAL serves a decimated read from the matching overview
+    return src.read(band, window=window, out_shape=out_shape)
+
+
+def read_overview(src, band, nodata=(-9999,), level=-1):
+    """Read ``band`` from an overview instead of the full resolution data."""
+    factor = overview_factor(src, band, level)
+    return _mask(_read_decimated(src, band, factor), nodata)
+
+
+def overview_error(src, band, nodata=(-9999,), level=-1, blocks=4, seed=0):
+    """Error bound of the statistics computed from an overview.
+
+    Up to ``blocks`` randomly chosen blocks are read at full resolution and
+    from the overview. The largest absolute difference of each statistic
+    between the two is returned.
+    """
+    factor = overview_factor(src, band, level)
+    windows = [window for _, window in src.block_windows(band)]
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(len(windows), size=min(blocks, len(windows)), replace=False)
+
+    error = {}
+    for index in sorted(chosen):
+        window = windows[index]
+        full = StreamingStats.from_array(
+            _mask(src.read(band, window=window), nodata)
+        ).to_dict()
+        coarse = StreamingStats.from_array(
+            _mask(_read_decimated(src, band, factor, window), nodata)
+        ).to_dict()
+        for name, value in full.items():
+            difference = abs(value - coarse[name])
+            if not np.isnan(difference):
+                error[name] = max(error.get(name, 0.0), difference)
+    return error
@@ -1,3 +1,5 @@
+import argparse
+from functools import partial
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -12,11 +14,17 @@ import calendar
 import seaborn as sns
 import json
 import re
+import sys
 from rasterio.vrt import WarpedVRT
 import xarray
 
 from dotenv import load_dotenv
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from cog_env import cog_env, s3_path
+from parallel_stats import StatsRecord, reduce_records
+from s3_keys import list_keys
+
 load_dotenv()
 
 # session_veda_smce = boto3.session.Session()
@@ -26,81 +34,38 @@ session_veda_smce = boto3.Session(
     aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
 )
 s3_client_veda_smce = session_veda_smce.client("s3")
-raster_io_session = rasterio.env.Env(
-    aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
-)
+raster_io_session = cog_env(session_veda_smce)
 bucket_name = "ghgc-data-store-dev"
 
 
-def get_all_s3_keys(bucket):
-    """Get a list of all keys in an S3 bucket."""
-    keys = []
-
-    kwargs = {"Bucket": bucket, "Prefix": "GEOS-Carbs/"}
-    while True:
-        resp = s3_client_veda_smce.list_objects_v2(**kwargs)
-        for obj in resp["Contents"]:
-            if obj["Key"].endswith(".tif"):
-                keys.append(obj["Key"])
-
-        try:
-            kwargs["ContinuationToken"] = resp["NextContinuationToken"]
-        except KeyError:
-            break
-
-    return keys
-
-
-keys = get_all_s3_keys(bucket_name)
-
-# List all TIFF files in the folder
-tif_files = glob("../../data/casa-gfed/*.nc", recursive=True)
-session = rasterio.env.Env()
-summary_dict_netcdf, summary_dict_cog = {}, {}
-overall_stats_netcdf, overall_stats_cog = {}, {}
-full_data_df_netcdf, full_data_df_cog = pd.DataFrame(), pd.DataFrame()
-
-for key in keys:
+def cog_stats(key, approximate=False):
+    """Statistics for every band of one transformed COG."""
+    record = StatsRecord(key)
     with raster_io_session:
-        s3_file = s3_client_veda_smce.generate_presigned_url(
-            "get_object", Params={"Bucket": bucket_name, "Key": key}
-        )
-        filename_elements = re.split("[_ ? . ]", s3_file)
-        with rasterio.open(s3_file) as src:
+        filename_elements = re.split("[_ ? . ]", key)
+        # Samples of the 2003 NPP and FIRE fluxes for the distribution plots
+        samples = [
+            flux
+            for flux in ("NPP", "FIRE")
+            if flux in "_".join(filename_elements[1:7])
+            and "2003" in filename_elements[7]
+        ]
+        with rasterio.open(s3_path(bucket_name, key)) as src:
             for band in src.indexes:
-                idx = pd.MultiIndex.from_product(
-                    [
-                        ["_".join(filename_elements[4:10])],
-                        [filename_elements[10]],
-                        [x for x in np.arange(1, src.height + 1)],
-                    ]
-                )
-                # Read the raster data
-                raster_data = src.read(band)
-                raster_data[raster_data == -9999] = np.nan
-                temp = pd.DataFrame(index=idx, data=raster_data)
-                full_data_df_cog = full_data_df_cog._append(temp, ignore_index=False)
-
                 # Calculate summary statistics
-                min_value = np.float64(np.nanmin(temp.values))
-                max_value = np.float64(np.nanmax(temp.values))
-                mean_value = np.float64(np.nanmean(temp.values))
-                std_value = np.float64(np.nanstd(temp.values))
+                record.add_band(
+                    f"{'_'.join(filename_elements[1:7])}_{filename_elements[7][:4]}_{calendar.month_name[int(filename_elements[7][4:6])]}",
+                    src,
+                    band,
+                    samples,
+                    approximate=approximate,
+                )
+    return record
 
-                summary_dict_cog[
-                    f"{'_'.join(filename_elements[4:10])}_{filename_elements[10][:4]}_{calendar.month_name[int(filename_elements[10][4:6])]}"
-                ] = {
-                    "min_value": min_value,
-                    "max_value": max_value,
-                    "mean_value": mean_value,
-                    "std_value": std_value,
-                }
 
-COG_PROFILE = {"driver": "COG", "compress": "DEFLATE"}
-# Iterate over each TIFF file
-for tif_file in tif_files:
+def netcdf_stats(tif_file):
+    """Statistics for every variable and time step of one raw netCDF file."""
+    record = StatsRecord(tif_file)
     file_name = re.split("[_ ? . ]", pathlib.Path(tif_file).name[:-3])
 
     xds = xarray.open_dataset(tif_file, engine="netcdf4")
@@ -111,164 +76,188 @@ for tif_file in tif_files:
     for time_increment in range(0, len(xds.time)):
         for var in variable[:-1]:
             data = getattr(xds.isel(time=time_increment), var)
-            data = data.isel(latitude=slice(None, None, -1))
-            idx = pd.MultiIndex.from_product(
+            data = data.isel(latitude=slice(None, None, -1)).values
+            label = "_".join(
                 [
-                    [
-                        "_".join(
-                            [
-                                file_name[1],
-                                var,
-                                file_name[2],
-                                file_name[3],
-                                file_name[4],
-                                file_name[5],
-                            ]
-                        )
-                    ],
-                    [file_name[-1]],
-                    [x for x in np.arange(1, len(data.latitude) + 1)],
+                    file_name[1],
+                    var,
+                    file_name[2],
+                    file_name[3],
+                    file_name[4],
+                    file_name[5],
                 ]
             )
 
-            temp = pd.DataFrame(index=idx, data=data)
-            full_data_df_netcdf = full_data_df_netcdf._append(temp, ignore_index=False)
-
             # Calculate summary statistics
-            min_value = np.float64(np.nanmin(temp.values))
-            max_value = np.float64(np.nanmax(temp.values))
-            mean_value = np.float64(np.nanmean(temp.values))
-            std_value = np.float64(np.nanstd(temp.values))
-
-            summary_dict_netcdf[
-                f"{'_'.join([file_name[1],var,file_name[2],file_name[3],file_name[4],file_name[5]])}_{file_name[6]}_{calendar.month_name[time_increment+1]}"
-            ] = {
-                "min_value": min_value,
-                "max_value": max_value,
-                "mean_value": mean_value,
-                "std_value": std_value,
-            }
-
-
-overall_stats_netcdf["min_value"] = np.float64(full_data_df_netcdf.values.min())
-overall_stats_netcdf["max_value"] = np.float64(full_data_df_netcdf.values.max())
-overall_stats_netcdf["mean_value"] = np.float64(full_data_df_netcdf.values.mean())
-overall_stats_netcdf["std_value"] = np.float64(full_data_df_netcdf.values.std())
-
-overall_stats_cog["min_value"] = np.float64(full_data_df_cog.values.min())
-overall_stats_cog["max_value"] = np.float64(full_data_df_cog.values.max())
-overall_stats_cog["mean_value"] = np.float64(full_data_df_cog.values.mean())
-overall_stats_cog["std_value"] = np.float64(full_data_df_cog.values.std())
-
-
-with open(
-    "monthly_stats.json",
-    "w",
-) as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_cog, fp)
-
-with open("overall_stats.json", "w") as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_cog, fp)
-
-fig, ax = plt.subplots(2, 2, figsize=(13, 10))
-temp_df = pd.DataFrame()
-for key_value in full_data_df_netcdf.index.values:
-    if "NPP" in key_value[0] and "2003" in key_value[1]:
-        temp_df = temp_df._append(full_data_df_netcdf.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[0][0])
-ax[0][0].set_title("NPP Emission \n (Original Data)")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_cog.index.values:
-    if "NPP" in key_value[0] and "2003" in key_value[1]:
-        temp_df = temp_df._append(full_data_df_cog.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[0][1])
-ax[0][1].set_title("NPP Emission \n (Transformed COG Data)")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_netcdf.index.values:
-    if "FIRE" in key_value[0] and "2003" in key_value[1]:
-        temp_df = temp_df._append(full_data_df_netcdf.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[1][0])
-ax[1][0].set_title("FIRE Emission \n (Original Data)")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_cog.index.values:
-    if "FIRE" in key_value[0] and "2003" in key_value[1]:
-        temp_df = temp_df._append(full_data_df_cog.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[1][1])
-ax[1][1].set_title("FIRE Emission \n (Transformed COG Data)")
-
-fig.tight_layout(pad=0.5)
-fig.suptitle("Overall distribution of data", fontsize=10)
-plt.savefig("overall_stats_summary.png")
-plt.show()
+            record.add(
+                f"{label}_{file_name[6]}_{calendar.month_name[time_increment+1]}",
+                data,
+                [
+                    flux
+                    for flux in ("NPP", "FIRE")
+                    if flux in label and "2003" in file_name[-1]
+                ],
+            )
+    return record
 
 
-fig, ax = plt.subplots(2, 2, figsize=(12, 12))
-temp_df = pd.DataFrame()
-for key_value in summary_dict_netcdf.keys():
-    if key_value.startswith("CASAGFED3v3_NPP_Flux_Monthly_x720_y360_2003"):
-        temp_df = temp_df._append(summary_dict_netcdf[key_value], ignore_index=True)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of files processed in parallel, 1 runs serially",
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="read the COGs from their coarsest overview and report an error bound",
+    )
+    args = parser.parse_args()
 
-sns.lineplot(
-    data=temp_df,
-    ax=ax[0][0],
-)
-ax[0][0].set_title("NPP Emission for 2003 \n (Original Data)")
-ax[0][0].set_xlabel("Months")
+    keys = list_keys(s3_client_veda_smce, bucket_name, "GEOS-Carbs/")
 
-temp_df = pd.DataFrame()
-for key_value in summary_dict_cog.keys():
-    if key_value.startswith("CASAGFED3v3_NPP_Flux_Monthly_x720_y360_2003"):
-        temp_df = temp_df._append(summary_dict_cog[key_value], ignore_index=True)
-sns.lineplot(
-    data=temp_df,
-    ax=ax[0][1],
-)
-ax[0][1].set_title("NPP Emission for 2003 \n (Transformed COG Data)")
-ax[0][1].set_xlabel("Months")
+    # List all TIFF files in the folder
+    tif_files = glob("../../data/casa-gfed/*.nc", recursive=True)
 
-temp_df = pd.DataFrame()
-for key_value in summary_dict_netcdf.keys():
-    if key_value.startswith("CASAGFED3v3_FIRE_Flux_Monthly_x720_y360_2003"):
-        temp_df = temp_df._append(summary_dict_netcdf[key_value], ignore_index=True)
+    record_cog = reduce_records(
+        partial(cog_stats, approximate=args.approximate), keys, args.workers
+    )
+    record_netcdf = reduce_records(netcdf_stats, tif_files, args.workers)
+
+    summary_dict_netcdf, summary_dict_cog = record_netcdf.summary, record_cog.summary
+    overall_stats_netcdf = record_netcdf.overall.to_dict()
+    overall_stats_cog = record_cog.overall.to_dict()
+
+    with open(
+        "monthly_stats.json",
+        "w",
+    ) as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_cog, fp)
+
+    with open("overall_stats.json", "w") as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_cog, fp)
+        if args.approximate:
+            fp.write("\n")
+            json.dump("Error bound of the approximate COG stats.", fp)
+            fp.write("\n")
+            json.dump(record_cog.error_bound, fp)
+
+    fig, ax = plt.subplots(2, 2, figsize=(13, 10))
+    sns.histplot(
+        data=record_netcdf.sample("NPP").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[0][0],
+    )
+    ax[0][0].set_title("NPP Emission \n (Original Data)")
+
+    sns.histplot(
+        data=record_cog.sample("NPP").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[0][1],
+    )
+    ax[0][1].set_title("NPP Emission \n (Transformed COG Data)")
+
+    sns.histplot(
+        data=record_netcdf.sample("FIRE").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[1][0],
+    )
+    ax[1][0].set_title("FIRE Emission \n (Original Data)")
+
+    sns.histplot(
+        data=record_cog.sample("FIRE").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[1][1],
+    )
+    ax[1][1].set_title("FIRE Emission \n (Transformed COG Data)")
+
+    fig.tight_layout(pad=0.5)
+    fig.suptitle("Overall distribution of data", fontsize=10)
+    plt.savefig("overall_stats_summary.png")
+    plt.show()
+
+    fig, ax = plt.subplots(2, 2, figsize=(12, 12))
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_netcdf.items()
+            if key_value.startswith("CASAGFED3v3_NPP_Flux_Monthly_x720_y360_2003")
+        ]
+    )
 
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][0],
-)
-ax[1][0].set_title("FIRE Emission for 2003 \n (Original Data)")
-ax[1][0].set_xlabel("Months")
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[0][0],
+    )
+    ax[0][0].set_title("NPP Emission for 2003 \n (Original Data)")
+    ax[0][0].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_cog.items()
+            if key_value.startswith("CASAGFED3v3_NPP_Flux_Monthly_x720_y360_2003")
+        ]
+    )
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[0][1],
+    )
+    ax[0][1].set_title("NPP Emission for 2003 \n (Transformed COG Data)")
+    ax[0][1].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_netcdf.items()
+            if key_value.startswith("CASAGFED3v3_FIRE_Flux_Monthly_x720_y360_2003")
+        ]
+    )
 
-temp_df = pd.DataFrame()
-for key_value in summary_dict_cog.keys():
-    if key_value.startswith("CASAGFED3v3_FIRE_Flux_Monthly_x720_y360_2003"):
-        temp_df = temp_df._append(summary_dict_cog[key_value], ignore_index=True)
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][1],
-)
-ax[1][1].set_title("FIRE Emission for 2003 \n (Transformed COG Data)")
-ax[1][1].set_xlabel("Months")
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][0],
+    )
+    ax[1][0].set_title("FIRE Emission for 2003 \n (Original Data)")
+    ax[1][0].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_cog.items()
+            if key_value.startswith("CASAGFED3v3_FIRE_Flux_Monthly_x720_y360_2003")
+        ]
+    )
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][1],
+    )
+    ax[1][1].set_title("FIRE Emission for 2003 \n (Transformed COG Data)")
+    ax[1][1].set_xlabel("Months")
 
-fig.tight_layout(pad=0.5)
-fig.suptitle("Plot for the Statistical values of data", fontsize=10)
-plt.savefig("monthly_stats_summary.png")
-plt.show()
+    fig.tight_layout(pad=0.5)
+    fig.suptitle("Plot for the Statistical values of data", fontsize=10)
+    plt.savefig("monthly_stats_summary.png")
+    plt.show()
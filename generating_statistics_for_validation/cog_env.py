@@ -0,0 +1,44 @@
+import rasterio
+from rasterio.session import AWSSession
+
+# GDAL configuration for reading COGs from S3. The COG header and tiles are
+# fetched with HTTP range requests; the options below keep that to as few
+# requests as possible and reuse connections between files.
+# user_data_notebooks/ghgc_utils.py holds a copy for the notebooks, which are
+# used on their own: keep the two the same.
+GDAL_OPTIONS = {
+    # Do not list the S3 "directory" of every file looking for sidecar files
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.TIF,.tiff",
+    # Merge reads of neighbouring tiles into a single range request
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    # Bounded cache of the bytes already downloaded, per file and per process
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(64 * 1024 * 1024),
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 * 1024 * 1024),
+    "GDAL_CACHEMAX": 512,
+    # HTTP/2 with multiplexing where the endpoint offers it, keep-alive
+    # connections otherwise
+    "GDAL_HTTP_VERSION": "2TLS",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_TCP_KEEPALIVE": "YES",
+    "GDAL_HTTP_MAX_RETRY": 3,
+    "GDAL_HTTP_RETRY_DELAY": 1,
+}
+
+
+def cog_env(boto3_session=None, **options):
+    """rasterio environment for reading COGs through ``/vsis3/`` paths.
+
+    ``boto3_session`` provides the AWS credentials, by default they are looked
+    up the same way boto3 does. ``options`` override ``GDAL_OPTIONS``. Create
+    the environment once per process and enter it for every file, so that the
+    connections and the download cache are shared between files.
+    """
+    session = AWSSession(boto3_session) if boto3_session else AWSSession()
+    return rasterio.Env(session=session, **{**GDAL_OPTIONS, **options})
+
+
+def s3_path(bucket, key):
+    """GDAL path of an S3 object."""
+    return f"/vsis3/{bucket}/{key}"
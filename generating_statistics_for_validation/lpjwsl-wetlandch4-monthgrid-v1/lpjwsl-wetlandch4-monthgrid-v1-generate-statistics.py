@@ -1,3 +1,5 @@
+import argparse
+from functools import partial
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,9 +13,16 @@ import pandas as pd
 import calendar
 import seaborn as sns
 import json
+import sys
 
 from dotenv import load_dotenv
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from cog_env import cog_env, s3_path
+from block_reader import read_blocks
+from parallel_stats import StatsRecord, reduce_records
+from s3_keys import list_keys
+
 load_dotenv()
 
 # session_veda_smce = boto3.session.Session()
@@ -23,172 +32,150 @@ session_veda_smce = boto3.Session(
     aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
 )
 s3_client_veda_smce = session_veda_smce.client("s3")
-raster_io_session = rasterio.env.Env(
-    aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
-)
+raster_io_session = cog_env(session_veda_smce)
 bucket_name = "ghgc-data-store-dev"
 
-keys = []
-resp = s3_client_veda_smce.list_objects_v2(
-    Bucket=bucket_name, Prefix="NASA_GSFC_ch4_wetlands_monthly/"
-)
-for obj in resp["Contents"]:
-    if obj["Key"].endswith(".tif"):
-        keys.append(obj["Key"])
-
-# List all TIFF files in the folder
-tif_files = glob("../../data/wetlands-monthly/*.nc", recursive=True)
-# tif_files = glob("data/wetlands-monthly/*.nc", recursive=True)
-session = rasterio.env.Env()
-summary_dict_netcdf, summary_dict_cog = {}, {}
-overall_stats_netcdf, overall_stats_cog = {}, {}
-full_data_df_netcdf, full_data_df_cog = pd.DataFrame(), pd.DataFrame()
-
-for key in keys:
+
+def cog_stats(key, approximate=False):
+    """Statistics for every band of one transformed COG."""
+    record = StatsRecord(key)
     with raster_io_session:
-        s3_file = s3_client_veda_smce.generate_presigned_url(
-            "get_object", Params={"Bucket": bucket_name, "Key": key}
-        )
-        with rasterio.open(s3_file) as src:
+        with rasterio.open(s3_path(bucket_name, key)) as src:
             for band in src.indexes:
-                idx = pd.MultiIndex.from_product(
-                    [
-                        [s3_file.split("_")[-1]],
-                        [s3_file.split("_")[-1][5]],
-                        [x for x in np.arange(1, src.height + 1)],
-                    ]
+                # Calculate summary statistics
+                record.add_band(
+                    f'{key.split("_")[-1][:4]}_{calendar.month_name[int(key.split("_")[-1][4:6])]}',
+                    src,
+                    band,
+                    ["overall"],
+                    approximate=approximate,
                 )
-                # Read the raster data
-                raster_data = src.read(band)
-                raster_data[raster_data == -9999] = np.nan
-                temp = pd.DataFrame(index=idx, data=raster_data)
-                full_data_df_cog = full_data_df_cog._append(temp, ignore_index=False)
+    return record
 
-                # Calculate summary statistics
-                min_value = np.float64(temp.values.min())
-                max_value = np.float64(temp.values.max())
-                mean_value = np.float64(temp.values.mean())
-                std_value = np.float64(temp.values.std())
-
-                summary_dict_cog[
-                    f'{s3_file.split("_")[-1][:4]}_{calendar.month_name[int(s3_file.split("_")[-1][4:6])]}'
-                ] = {
-                    "min_value": min_value,
-                    "max_value": max_value,
-                    "mean_value": mean_value,
-                    "std_value": std_value,
-                }
-
-# Iterate over each TIFF file
-for tif_file in tif_files:
-    file_name = pathlib.Path(tif_file).name[:-3]
+
+def netcdf_stats(tif_file):
+    """Statistics for every monthly band of one raw netCDF file."""
+    record = StatsRecord(tif_file)
 
     # Open the TIFF file
     with rasterio.open(tif_file) as src:
         for band in src.indexes:
-            idx = pd.MultiIndex.from_product(
-                [
-                    [tif_file],
-                    [band],
-                    [x for x in np.arange(1, src.height + 1)],
-                ]
+            # Calculate summary statistics tile by tile
+            record.add_blocks(
+                f'{tif_file.split(".")[-2]}_{calendar.month_name[band]}',
+                read_blocks(src, band),
+                ["overall"],
+            )
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of files processed in parallel, 1 runs serially",
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="read the COGs from their coarsest overview and report an error bound",
+    )
+    args = parser.parse_args()
+
+    keys = list_keys(
+        s3_client_veda_smce, bucket_name, "NASA_GSFC_ch4_wetlands_monthly/"
+    )
+
+    # List all TIFF files in the folder
+    tif_files = glob("../../data/wetlands-monthly/*.nc", recursive=True)
+    # tif_files = glob("data/wetlands-monthly/*.nc", recursive=True)
+
+    record_cog = reduce_records(
+        partial(cog_stats, approximate=args.approximate), keys, args.workers
+    )
+    record_netcdf = reduce_records(netcdf_stats, tif_files, args.workers)
+
+    summary_dict_netcdf, summary_dict_cog = record_netcdf.summary, record_cog.summary
+    overall_stats_netcdf = record_netcdf.overall.to_dict()
+    # COG values are stored in different units, scale them to match the netCDF files
+    overall_stats_cog = record_cog.overall.scaled(1 / 1000).to_dict()
+
+    with open("monthly_stats.json", "w") as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_cog, fp)
+
+    with open("overall_stats.json", "w") as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_cog, fp)
+        if args.approximate:
+            fp.write("\n")
+            json.dump("Error bound of the approximate COG stats.", fp)
+            fp.write("\n")
+            json.dump(
+                {name: value / 1000 for name, value in record_cog.error_bound.items()},
+                fp,
             )
-            # Read the raster data
-            raster_data = src.read(band)
-            raster_data[raster_data == -9999] = np.nan
-            temp = pd.DataFrame(index=idx, data=raster_data)
-            full_data_df_netcdf = full_data_df_netcdf._append(temp, ignore_index=False)
-
-            # Calculate summary statistics
-            min_value = np.float64(temp.values.min())
-            max_value = np.float64(temp.values.max())
-            mean_value = np.float64(temp.values.mean())
-            std_value = np.float64(temp.values.std())
-
-            summary_dict_netcdf[
-                f'{tif_file.split(".")[-2]}_{calendar.month_name[band]}'
-            ] = {
-                "min_value": min_value,
-                "max_value": max_value,
-                "mean_value": mean_value,
-                "std_value": std_value,
-            }
-
-full_data_df_cog = full_data_df_cog/1000
-overall_stats_netcdf["min_value"] = np.float64(full_data_df_netcdf.values.min())
-overall_stats_netcdf["max_value"] = np.float64(full_data_df_netcdf.values.max())
-overall_stats_netcdf["mean_value"] = np.float64(full_data_df_netcdf.values.mean())
-overall_stats_netcdf["std_value"] = np.float64(full_data_df_netcdf.values.std())
-
-overall_stats_cog["min_value"] = np.float64(full_data_df_cog.values.min())
-overall_stats_cog["max_value"] = np.float64(full_data_df_cog.values.max())
-overall_stats_cog["mean_value"] = np.float64(full_data_df_cog.values.mean())
-overall_stats_cog["std_value"] = np.float64(full_data_df_cog.values.std())
-
-
-with open("monthly_stats.json", "w") as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_cog, fp)
-
-with open("overall_stats.json", "w") as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_cog, fp)
-
-fig, ax = plt.subplots(2, 2, figsize=(10, 10))
-plt.Figure(figsize=(10, 10))
-sns.histplot(
-    data=full_data_df_netcdf.to_numpy().flatten(),
-    kde=False,
-    bins=100,
-    legend=False,
-    ax=ax[0][0],
-)
-ax[0][0].set_title("distribution plot for overall raw data")
-
-sns.histplot(
-    data=full_data_df_cog.to_numpy().flatten(),
-    kde=False,
-    bins=100,
-    legend=False,
-    ax=ax[0][1],
-)
-ax[0][1].set_title("distribution plot for overall cog data")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_netcdf.keys():
-    if key_value.startswith("2009"):
-        temp_df = temp_df._append(summary_dict_netcdf[key_value], ignore_index=True)
-
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][0],
-)
-ax[1][0].set_title("distribution plot for 2009 raw data")
-ax[1][0].set_xlabel("Months")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_cog.keys():
-    if key_value.startswith("2009"):
-        temp_df = temp_df._append(summary_dict_cog[key_value], ignore_index=True)
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][1],
-)
-ax[1][1].set_title("distribution plot for 2009 cog data")
-ax[1][1].set_xlabel("Months")
-
 
-plt.savefig("stats_summary.png")
-plt.show()
+    fig, ax = plt.subplots(2, 2, figsize=(10, 10))
+    plt.Figure(figsize=(10, 10))
+    sns.histplot(
+        data=record_netcdf.sample("overall").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[0][0],
+    )
+    ax[0][0].set_title("distribution plot for overall raw data")
+
+    sns.histplot(
+        data=record_cog.sample("overall").values / 1000,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[0][1],
+    )
+    ax[0][1].set_title("distribution plot for overall cog data")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_netcdf.items()
+            if key_value.startswith("2009")
+        ]
+    )
+
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][0],
+    )
+    ax[1][0].set_title("distribution plot for 2009 raw data")
+    ax[1][0].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_cog.items()
+            if key_value.startswith("2009")
+        ]
+    )
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][1],
+    )
+    ax[1][1].set_title("distribution plot for 2009 cog data")
+    ax[1][1].set_xlabel("Months")
+
+    plt.savefig("stats_summary.png")
+    plt.show()
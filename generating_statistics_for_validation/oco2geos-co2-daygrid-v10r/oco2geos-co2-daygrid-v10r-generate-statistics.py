@@ -1,3 +1,5 @@
+import argparse
+from functools import partial
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -12,11 +14,17 @@ import calendar
 import seaborn as sns
 import json
 import re
+import sys
 from rasterio.vrt import WarpedVRT
 import xarray
 
 from dotenv import load_dotenv
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from cog_env import cog_env, s3_path
+from parallel_stats import StatsRecord, reduce_records
+from s3_keys import list_keys
+
 load_dotenv()
 
 # session_veda_smce = boto3.session.Session()
@@ -26,84 +34,38 @@ session_veda_smce = boto3.Session(
     aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
 )
 s3_client_veda_smce = session_veda_smce.client("s3")
-raster_io_session = rasterio.env.Env(
-    aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
-)
+raster_io_session = cog_env(session_veda_smce)
 bucket_name = "ghgc-data-store-dev"
 
 
-def get_all_s3_keys(bucket):
-    """Get a list of all keys in an S3 bucket."""
-    keys = []
-
-    kwargs = {"Bucket": bucket, "Prefix": "geos-oco2/"}
-    while True:
-        resp = s3_client_veda_smce.list_objects_v2(**kwargs)
-        for obj in resp["Contents"]:
-            if obj["Key"].endswith(".tif"):
-                keys.append(obj["Key"])
-
-        try:
-            kwargs["ContinuationToken"] = resp["NextContinuationToken"]
-        except KeyError:
-            break
-
-    return keys
-
-
-keys = get_all_s3_keys(bucket_name)
-
-# List all TIFF files in the folder
-tif_files = glob("data/oco2geos-co2-daygrid-v10r/*.nc4", recursive=True)
-session = rasterio.env.Env()
-summary_dict_netcdf, summary_dict_cog = {}, {}
-overall_stats_netcdf, overall_stats_cog = {}, {}
-full_data_df_netcdf, full_data_df_cog = pd.DataFrame(), pd.DataFrame()
-
-for key in keys:
+def cog_stats(key, approximate=False):
+    """Statistics for every band of one transformed COG."""
+    record = StatsRecord(key)
     with raster_io_session:
-        s3_file = s3_client_veda_smce.generate_presigned_url(
-            "get_object", Params={"Bucket": bucket_name, "Key": key}
-        )
-        filename_elements = re.split("[_ ? . ]", s3_file)
+        filename_elements = re.split("[_ ? . ]", key)
         try:
-            with rasterio.open(s3_file) as src:
+            with rasterio.open(s3_path(bucket_name, key)) as src:
                 for band in src.indexes:
-                    idx = pd.MultiIndex.from_product(
-                        [
-                            ["_".join(filename_elements[4:9])],
-                            [filename_elements[9]],
-                            [x for x in np.arange(1, src.height + 1)],
-                        ]
-                    )
-                    # Read the raster data
-                    raster_data = src.read(band)
-                    raster_data[raster_data == -9999] = np.nan
-                    temp = pd.DataFrame(index=idx, data=raster_data)
-                    full_data_df_cog = full_data_df_cog._append(temp, ignore_index=False)
-
                     # Calculate summary statistics
-                    min_value = np.float64(temp.values.min())
-                    max_value = np.float64(temp.values.max())
-                    mean_value = np.float64(temp.values.mean())
-                    std_value = np.float64(temp.values.std())
-
-                    summary_dict_cog[
-                        f"{filename_elements[5]}_{filename_elements[9][:4]}_{calendar.month_name[int(filename_elements[9][4:6])]}_{filename_elements[9][6:]}"
-                    ] = {
-                        "min_value": min_value,
-                        "max_value": max_value,
-                        "mean_value": mean_value,
-                        "std_value": std_value,
-                    }
+                    record.add_band(
+                        f"{filename_elements[2]}_{filename_elements[6][:4]}_{calendar.month_name[int(filename_elements[6][4:6])]}_{filename_elements[6][6:]}",
+                        src,
+                        band,
+                        samples=(
+                            ["XCO2"]
+                            if "_".join(filename_elements[1:6]).startswith("GEOS_XCO2_")
+                            else []
+                        ),
+                        approximate=approximate,
+                    )
         except:
-            print(s3_file)
+            print(key)
+    return record
+
 
-COG_PROFILE = {"driver": "COG", "compress": "DEFLATE"}
-# Iterate over each TIFF file
-for tif_file in tif_files:
+def netcdf_stats(tif_file):
+    """Statistics for every variable and time step of one raw netCDF file."""
+    record = StatsRecord(tif_file)
     file_name = pathlib.Path(tif_file).name[:-4].split("_")
 
     xds = xarray.open_dataset(tif_file, engine="netcdf4")
@@ -112,116 +74,122 @@ for tif_file in tif_files:
     for time_increment in range(0, len(xds.time)):
         for var in variable:
             data = getattr(xds.isel(time=time_increment), var)
-            data = data.isel(lat=slice(None, None, -1))
-            idx = pd.MultiIndex.from_product(
-                [
-                    [
-                        "_".join(
-                            [
-                                file_name[1],
-                                var,
-                                file_name[2],
-                                file_name[3],
-                                file_name[-1],
-                            ]
-                        )
-                    ],
-                    [file_name[-2]],
-                    [x for x in np.arange(1, len(data.lat) + 1)],
-                ]
-            )
-
-            temp = pd.DataFrame(index=idx, data=data)
-            full_data_df_netcdf = full_data_df_netcdf._append(temp, ignore_index=False)
+            data = data.isel(lat=slice(None, None, -1)).values
 
             # Calculate summary statistics
-            min_value = np.float64(temp.values.min())
-            max_value = np.float64(temp.values.max())
-            mean_value = np.float64(temp.values.mean())
-            std_value = np.float64(temp.values.std())
-
-            summary_dict_netcdf[
-                f"{var}_{file_name[-2][:4]}_{calendar.month_name[int(file_name[-2][4:6])]}_{file_name[-2][6:]}"
-            ] = {
-                "min_value": min_value,
-                "max_value": max_value,
-                "mean_value": mean_value,
-                "std_value": std_value,
-            }
-
-
-overall_stats_netcdf["min_value"] = np.float64(full_data_df_netcdf.values.min())
-overall_stats_netcdf["max_value"] = np.float64(full_data_df_netcdf.values.max())
-overall_stats_netcdf["mean_value"] = np.float64(full_data_df_netcdf.values.mean())
-overall_stats_netcdf["std_value"] = np.float64(full_data_df_netcdf.values.std())
-
-overall_stats_cog["min_value"] = np.float64(full_data_df_cog.values.min())
-overall_stats_cog["max_value"] = np.float64(full_data_df_cog.values.max())
-overall_stats_cog["mean_value"] = np.float64(full_data_df_cog.values.mean())
-overall_stats_cog["std_value"] = np.float64(full_data_df_cog.values.std())
-
-
-with open(
-    "monthly_stats.json",
-    "w",
-) as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_cog, fp)
-
-with open("overall_stats.json", "w") as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_cog, fp)
-
-
-fig, ax = plt.subplots(2, 2, figsize=(10, 10))
-# plt.Figure(figsize=(10, 10))
-temp_df = pd.DataFrame()
-for key_value in full_data_df_netcdf.index.values:
-    if key_value[0].startswith("GEOS_XCO2_"):
-        temp_df = temp_df._append(full_data_df_netcdf.loc[key_value])
-sns.histplot(data=temp_df, kde=False, bins=10, legend=False, ax=ax[0][0])
-ax[0][0].set_title("distribution plot for overall raw data")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_cog.index.values:
-    if key_value[0].startswith("GEOS_XCO2_"):
-        temp_df = temp_df._append(full_data_df_cog.loc[key_value])
-sns.histplot(data=temp_df, kde=False, bins=10, legend=False, ax=ax[0][1])
-ax[0][1].set_title("distribution plot for overall cog data")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_netcdf.keys():
-    if key_value.startswith("XCO2_2016"):
-        temp_df = temp_df._append(summary_dict_netcdf[key_value], ignore_index=True)
-
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][0],
-)
-ax[1][0].set_title("plot for XCO2 variable for 2016 raw data")
-ax[1][0].set_xlabel("Months")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_cog.keys():
-    if key_value.startswith("XCO2_2016"):
-        temp_df = temp_df._append(summary_dict_cog[key_value], ignore_index=True)
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][1],
-)
-ax[1][1].set_title("plot for XCO2 variable for 2016 cog data")
-ax[1][1].set_xlabel("Months")
-
-
-plt.savefig("stats_summary.png")
-plt.show()
+            record.add(
+                f"{var}_{file_name[-2][:4]}_{calendar.month_name[int(file_name[-2][4:6])]}_{file_name[-2][6:]}",
+                data,
+                samples=(
+                    ["XCO2"] if "_".join([file_name[1], var]) == "GEOS_XCO2" else []
+                ),
+            )
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of files processed in parallel, 1 runs serially",
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="read the COGs from their coarsest overview and report an error bound",
+    )
+    args = parser.parse_args()
+
+    keys = list_keys(s3_client_veda_smce, bucket_name, "geos-oco2/")
+
+    # List all TIFF files in the folder
+    tif_files = glob("data/oco2geos-co2-daygrid-v10r/*.nc4", recursive=True)
+
+    record_cog = reduce_records(
+        partial(cog_stats, approximate=args.approximate), keys, args.workers
+    )
+    record_netcdf = reduce_records(netcdf_stats, tif_files, args.workers)
+
+    summary_dict_netcdf, summary_dict_cog = record_netcdf.summary, record_cog.summary
+    overall_stats_netcdf = record_netcdf.overall.to_dict()
+    overall_stats_cog = record_cog.overall.to_dict()
+
+    with open(
+        "monthly_stats.json",
+        "w",
+    ) as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_cog, fp)
+
+    with open("overall_stats.json", "w") as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_cog, fp)
+        if args.approximate:
+            fp.write("\n")
+            json.dump("Error bound of the approximate COG stats.", fp)
+            fp.write("\n")
+            json.dump(record_cog.error_bound, fp)
+
+    fig, ax = plt.subplots(2, 2, figsize=(10, 10))
+    # plt.Figure(figsize=(10, 10))
+    sns.histplot(
+        data=record_netcdf.sample("XCO2").values,
+        kde=False,
+        bins=10,
+        legend=False,
+        ax=ax[0][0],
+    )
+    ax[0][0].set_title("distribution plot for overall raw data")
+
+    sns.histplot(
+        data=record_cog.sample("XCO2").values,
+        kde=False,
+        bins=10,
+        legend=False,
+        ax=ax[0][1],
+    )
+    ax[0][1].set_title("distribution plot for overall cog data")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_netcdf.items()
+            if key_value.startswith("XCO2_2016")
+        ]
+    )
+
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][0],
+    )
+    ax[1][0].set_title("plot for XCO2 variable for 2016 raw data")
+    ax[1][0].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_cog.items()
+            if key_value.startswith("XCO2_2016")
+        ]
+    )
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][1],
+    )
+    ax[1][1].set_title("plot for XCO2 variable for 2016 cog data")
+    ax[1][1].set_xlabel("Months")
+
+    plt.savefig("stats_summary.png")
+    plt.show()
@@ -0,0 +1,96 @@
+import multiprocessing
+import zlib
+
+from block_reader import overview_error, read_blocks, read_overview
+from streaming_stats import ReservoirSample, StreamingStats
+
+
+class StatsRecord:
+    """Mergeable statistics of one or more files.
+
+    A record holds the per-band summary written to ``monthly_stats.json``, the
+    running overall statistics, any samples kept for the distribution plots
+    and, for approximate runs, the error bound of the overview statistics.
+    Workers return one record per file and the parent merges them in input
+    order, so the output is identical to a serial run.
+    """
+
+    def __init__(self, name=""):
+        self.name = name
+        self.summary = {}
+        self.overall = StreamingStats()
+        self.samples = {}
+        self.error_bound = {}
+
+    def sample(self, sample_name):
+        """Sample ``sample_name`` of this record, created on first use."""
+        if sample_name not in self.samples:
+            seed = zlib.crc32(f"{self.name}/{sample_name}".encode())
+            self.samples[sample_name] = ReservoirSample(seed=seed)
+        return self.samples[sample_name]
+
+    def add(self, key, data, samples=()):
+        """Add one band to the summary under ``key`` and to the overall stats."""
+        return self.add_blocks(key, [data], samples)
+
+    def add_blocks(self, key, blocks, samples=()):
+        """Like ``add`` for a band given as an iterable of blocks.
+
+        The blocks are consumed one at a time, so the band never has to be
+        held in memory as a whole.
+        """
+        band_stats = StreamingStats()
+        for data in blocks:
+            band_stats.update(data)
+            for sample_name in samples:
+                self.sample(sample_name).update(data)
+        self.summary[key] = band_stats.to_dict()
+        self.overall.merge(band_stats)
+        return band_stats
+
+    def add_band(self, key, src, band, samples=(), nodata=(-9999,), approximate=False):
+        """Add ``band`` of an open rasterio dataset.
+
+        With ``approximate`` the band is read from its coarsest overview and
+        the error bound is updated from a few full resolution blocks.
+        """
+        if not approximate:
+            return self.add_blocks(key, read_blocks(src, band, nodata), samples)
+
+        seed = zlib.crc32(f"{self.name}/{key}".encode())
+        for name, value in overview_error(src, band, nodata, seed=seed).items():
+            self.error_bound[name] = max(self.error_bound.get(name, 0.0), value)
+        return self.add(key, read_overview(src, band, nodata), samples)
+
+    def merge(self, other):
+        """Combine ``other`` into this record, ``other`` coming after it."""
+        self.summary.update(other.summary)
+        self.overall.merge(other.overall)
+        for sample_name, sample in other.samples.items():
+            self.sample(sample_name).merge(sample)
+        for name, value in other.error_bound.items():
+            self.error_bound[name] = max(self.error_bound.get(name, 0.0), value)
+        return self
+
+
+def map_files(func, items, workers=1):
+    """Yield ``func(item)`` for every item, in the order of ``items``.
+
+    With more than one worker the items are handed out one per task to a
+    process pool. Results are still yielded in input order.
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    # GDAL and boto3 are not fork safe, start the workers from scratch
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        yield from pool.imap(func, items, chunksize=1)
+
+
+def reduce_records(func, items, workers=1):
+    """Merge the ``StatsRecord`` returned by ``func`` for every item."""
+    record = StatsRecord()
+    for file_record in map_files(func, items, workers):
+        record.merge(file_record)
+    return record
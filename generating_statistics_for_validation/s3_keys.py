@@ -0,0 +1,118 @@
+import json
+import os
+import pathlib
+import re
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+CACHE_DIR = pathlib.Path.home() / ".cache" / "ghgc-docs" / "s3-listings"
+
+# A year in a file name, e.g. 2009 in ..._20090101.tif
+_YEAR = re.compile(r"(?:19|20)\d{2}")
+
+
+def _split_points(client, bucket, prefix):
+    """Keys splitting the listing of ``prefix`` into one range per year.
+
+    The year in the name of the first key gives the file name stem, and the
+    stem followed by every later year up to now is a split point. Keys that do
+    not follow the stem still fall in one of the ranges, they only make the
+    ranges less even.
+    """
+    resp = client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1)
+    if not resp.get("Contents"):
+        return []
+    first_key = resp["Contents"][0]["Key"]
+    name_start = first_key.rfind("/") + 1
+    years = list(_YEAR.finditer(first_key, name_start))
+    if not years:
+        return []
+    stem = first_key[: years[-1].start()]
+    first_year = int(years[-1].group())
+    return [f"{stem}{year}" for year in range(first_year + 1, date.today().year + 1)]
+
+
+def _list_range(client, bucket, prefix, start_after, stop_at):
+    """(key, ETag) of the objects of ``prefix`` in ``(start_after, stop_at]``."""
+    objects = []
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after is not None:
+        kwargs["StartAfter"] = start_after
+    while True:
+        resp = client.list_objects_v2(**kwargs)
+        for obj in resp.get("Contents", []):
+            if stop_at is not None and obj["Key"] > stop_at:
+                return objects
+            objects.append((obj["Key"], obj["ETag"].strip('"')))
+
+        if not resp.get("IsTruncated"):
+            return objects
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+
+def _cache_file(cache_dir, bucket, prefix):
+    cache_name = f"{zlib.crc32(f'{bucket}/{prefix}'.encode()):08x}.json"
+    return pathlib.Path(cache_dir) / cache_name
+
+
+def _write_objects(cache_file, bucket, prefix, objects):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, partial_file = tempfile.mkstemp(dir=cache_file.parent, suffix=".part")
+    with os.fdopen(fd, "w") as fp:
+        json.dump({"bucket": bucket, "prefix": prefix, "objects": objects}, fp)
+    os.replace(partial_file, cache_file)
+
+
+def list_objects(client, bucket, prefix, workers=8, cache_dir=CACHE_DIR, max_age=3600):
+    """Yield ``(key, etag)`` for every object under ``prefix``, in key order.
+
+    The key range is split on the years in the file names and the ranges are
+    listed concurrently, each following the continuation tokens until it is
+    exhausted. Keys are yielded as soon as the listing of their range is done,
+    so the caller can start reading files while later years are still being
+    listed.
+
+    The complete listing, with the ETags, is cached in ``cache_dir``, also
+    when the caller stops iterating early, and a rerun comparing the ETags
+    spots the objects that changed. A cached listing is served as is for
+    ``max_age`` seconds after it was written, so objects added, removed or
+    rewritten in that time are not seen; pass ``max_age=0`` or
+    ``cache_dir=None`` to always list.
+    """
+    if cache_dir is not None:
+        cache_file = _cache_file(cache_dir, bucket, prefix)
+        if cache_file.exists() and time.time() - cache_file.stat().st_mtime < max_age:
+            with open(cache_file) as fp:
+                for key, etag in json.load(fp)["objects"]:
+                    yield key, etag
+            return
+    points = _split_points(client, bucket, prefix)
+    ranges = list(zip([None] + points, points + [None]))
+    futures = []
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(_list_range, client, bucket, prefix, start, stop)
+                for start, stop in ranges
+            ]
+            for future in futures:
+                yield from future.result()
+    finally:
+        # Leaving the executor waited for all the ranges
+        if cache_dir is not None and all(not f.exception() for f in futures):
+            objects = [obj for future in futures for obj in future.result()]
+            _write_objects(cache_file, bucket, prefix, objects)
+
+
+def list_keys(client, bucket, prefix, suffix=".tif", pattern=None, **kwargs):
+    """Yield the keys under ``prefix`` ending with ``suffix``.
+
+    If ``pattern`` is given only keys matching it are kept. The keys are
+    listed by ``list_objects``, which takes the other keyword arguments.
+    """
+    for key, _ in list_objects(client, bucket, prefix, **kwargs):
+        if key.endswith(suffix) and (pattern is None or re.search(pattern, key)):
+            yield key
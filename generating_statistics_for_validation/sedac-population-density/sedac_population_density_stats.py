@@ -1,3 +1,5 @@
+import argparse
+from functools import partial
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -13,9 +15,16 @@ import seaborn as sns
 import json
 import xarray
 import re
+import sys
 
 from dotenv import load_dotenv
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from cog_env import cog_env, s3_path
+from block_reader import band_minimum, read_blocks
+from parallel_stats import StatsRecord, reduce_records
+from s3_keys import list_keys
+
 load_dotenv()
 
 # session_veda_smce = boto3.session.Session()
@@ -25,248 +34,222 @@ session_veda_smce = boto3.Session(
     aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
 )
 s3_client_veda_smce = session_veda_smce.client("s3")
-raster_io_session = rasterio.env.Env(
-    aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
-)
+raster_io_session = cog_env(session_veda_smce)
 bucket_name = "ghgc-data-store-dev"
 
 
-def get_all_s3_keys(bucket):
-    """Get a list of all keys in an S3 bucket."""
-    keys = []
-
-    kwargs = {"Bucket": bucket, "Prefix": "gridded_population_cog"}
-    while True:
-        resp = s3_client_veda_smce.list_objects_v2(**kwargs)
-        for obj in resp["Contents"]:
-            if obj["Key"].endswith(".tif"):
-                keys.append(obj["Key"])
-
-        try:
-            kwargs["ContinuationToken"] = resp["NextContinuationToken"]
-        except KeyError:
-            break
-
-    return keys
-
-
-keys = get_all_s3_keys(bucket_name)
-
-# List all TIFF files in the folder
-tif_files = glob("data/gpw/*.tif", recursive=True)
-session = rasterio.env.Env()
-summary_dict_netcdf, summary_dict_cog = {}, {}
-overall_stats_netcdf, overall_stats_cog = {}, {}
-full_data_df_netcdf, full_data_df_cog = pd.DataFrame(), pd.DataFrame()
-
-for key in keys:
+def cog_stats(key, approximate=False):
+    """Statistics for every band of one transformed COG."""
+    record = StatsRecord(key)
     with raster_io_session:
-        s3_file = s3_client_veda_smce.generate_presigned_url(
-            "get_object", Params={"Bucket": bucket_name, "Key": key}
-        )
-        filename_elements = re.split("[_ ? . / ]", s3_file)
-        with rasterio.open(s3_file) as src:
+        filename_elements = re.split("[_ ? . / ]", key)
+        # Samples of the total and microbial emissions for the distribution plots
+        samples = [
+            emission
+            for emission in ("emis_total", "emis_microbial")
+            if "_".join(filename_elements[:11]).startswith(emission)
+        ]
+        with rasterio.open(s3_path(bucket_name, key)) as src:
             for band in src.indexes:
-                idx = pd.MultiIndex.from_product(
-                    [
-                        ["_".join(filename_elements[6:17])],
-                        [filename_elements[17]],
-                        [x for x in np.arange(1, src.height + 1)],
-                    ]
-                )
-                # Read the raster data
-                raster_data = src.read(band)
-                raster_data[raster_data == np.min(raster_data)] = np.nan
-                # raster_data[raster_data == 9.969209968386869e36] = np.nan
-                temp = pd.DataFrame(index=idx, data=raster_data)
-                full_data_df_cog = full_data_df_cog._append(
-                    temp, ignore_index=False
-                )
+                # The fill value is the band minimum, only scan for it when
+                # the file does not declare it
+                nodata = src.nodata
+                if nodata is None:
+                    nodata = band_minimum(src, band)
 
                 # Calculate summary statistics
-                min_value = np.float64(np.nanmin(temp.values))
-                max_value = np.float64(np.nanmax(temp.values))
-                mean_value = np.float64(np.nanmean(temp.values))
-                std_value = np.float64(np.nanstd(temp.values))
+                record.add_band(
+                    f"{'_'.join(filename_elements[:12])}",
+                    src,
+                    band,
+                    samples,
+                    nodata=(nodata,),
+                    approximate=approximate,
+                )
+    return record
 
-                summary_dict_cog[
-                    f"{'_'.join(filename_elements[6:18])}"
-                ] = {
-                    "min_value": min_value,
-                    "max_value": max_value,
-                    "mean_value": mean_value,
-                    "std_value": std_value,
-                }
 
-# Iterate over each TIFF file
+def tif_stats(tif_file):
+    """Statistics for every band of one raw GPW GeoTIFF."""
+    record = StatsRecord(tif_file)
+    file_name = pathlib.Path(tif_file).stem
 
-COG_PROFILE = {"driver": "COG", "compress": "DEFLATE"}
-# Iterate over each TIFF file
-for tif_file in tif_files:
-    file_name = pathlib.Path(tif_file).name[:-3].split("_")
+    with rasterio.open(tif_file) as src:
+        for band in src.indexes:
+            nodata = src.nodata
+            if nodata is None:
+                nodata = band_minimum(src, band)
 
-    xds = xarray.open_dataset(tif_file, engine="netcdf4")
-    xds = xds.rename({"latitude": "lat", "longitude": "lon"})
-    xds = xds.assign_coords(lon=(((xds.lon + 180) % 360) - 180)).sortby("lon")
-    for time_increment in range(0, len(xds.months)):
-        for var in variable:
-            data = getattr(xds.isel(months=time_increment), var)
-            data = data.isel(lat=slice(None, None, -1))
-            idx = pd.MultiIndex.from_product(
+            # Calculate summary statistics tile by tile
+            record.add_blocks(
+                file_name,
+                read_blocks(src, band, nodata=(nodata,)),
                 [
-                    [
-                        "_".join(
-                            [
-                                file_name[1],
-                                var,
-                            ]
-                        )
-                    ],
-                    [f"{file_name[2]}{time_increment+1}"],
-                    [x for x in np.arange(1, len(data.lat) + 1)],
-                ]
+                    emission
+                    for emission in ("emis_total", "emis_microbial")
+                    if file_name.startswith(emission)
+                ],
             )
-            temp = pd.DataFrame(index=idx, data=data)
-            temp[temp == 9.969209968386869e36] = np.nan
-            full_data_df_netcdf = full_data_df_netcdf._append(temp, ignore_index=False)
-
-            # Calculate summary statistics
-            min_value = np.float64(np.nanmin(temp.values))
-            max_value = np.float64(np.nanmax(temp.values))
-            mean_value = np.float64(np.nanmean(temp.values))
-            std_value = np.float64(np.nanstd(temp.values))
-
-            summary_dict_netcdf[
-                f"{var}_{file_name[2]}_{calendar.month_name[time_increment+1]}"
-            ] = {
-                "min_value": min_value,
-                "max_value": max_value,
-                "mean_value": mean_value,
-                "std_value": std_value,
-            }
-
-overall_stats_netcdf["min_value"] = np.float64(np.nanmin(full_data_df_netcdf.values))
-overall_stats_netcdf["max_value"] = np.float64(np.nanmax(full_data_df_netcdf.values))
-overall_stats_netcdf["mean_value"] = np.float64(np.nanmean(full_data_df_netcdf.values))
-overall_stats_netcdf["std_value"] = np.float64(np.nanstd(full_data_df_netcdf.values))
-
-overall_stats_cog["min_value"] = np.float64(np.nanmin(full_data_df_cog.values))
-overall_stats_cog["max_value"] = np.float64(np.nanmax(full_data_df_cog.values))
-overall_stats_cog["mean_value"] = np.float64(np.nanmean(full_data_df_cog.values))
-overall_stats_cog["std_value"] = np.float64(np.nanstd(full_data_df_cog.values))
-
-
-with open(
-    "monthly_stats.json",
-    "w",
-) as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(summary_dict_cog, fp)
-
-with open("overall_stats.json", "w") as fp:
-    json.dump("Stats for raw netCDF files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_netcdf, fp)
-    fp.write("\n")
-    json.dump("Stats for transformed COG files.", fp)
-    fp.write("\n")
-    json.dump(overall_stats_cog, fp)
-
-
-fig, ax = plt.subplots(2, 2, figsize=(13, 10))
-temp_df = pd.DataFrame()
-for key_value in full_data_df_netcdf.index.values:
-    if key_value[0].startswith("emis_total"):
-        temp_df = temp_df._append(full_data_df_netcdf.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[0][0])
-ax[0][0].set_title("Total CH4 Emission \n (Original Data)")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_cog.index.values:
-    if key_value[0].startswith("emis_total"):
-        temp_df = temp_df._append(full_data_df_cog.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[0][1])
-ax[0][1].set_title("Total CH4 Emission \n (Transformed COG Data)")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_netcdf.index.values:
-    if key_value[0].startswith("emis_microbial"):
-        temp_df = temp_df._append(full_data_df_netcdf.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[1][0])
-ax[1][0].set_title("Microbial CH4 Emission \n (Original Data)")
-
-temp_df = pd.DataFrame()
-for key_value in full_data_df_cog.index.values:
-    if key_value[0].startswith("emis_microbial"):
-        temp_df = temp_df._append(full_data_df_cog.loc[key_value])
-temp_df = temp_df.to_numpy().flatten()
-sns.histplot(data=temp_df, kde=False, bins=100, legend=False, ax=ax[1][1])
-ax[1][1].set_title("Microbial CH4 Emission \n (Transformed COG Data)")
-
-fig.tight_layout(pad=0.5)
-fig.suptitle("Overall distribution of data", fontsize=10)
-plt.savefig("overall_stats_summary.png")
-plt.show()
-
-
-fig, ax = plt.subplots(2, 2, figsize=(12, 12))
-temp_df = pd.DataFrame()
-for key_value in summary_dict_netcdf.keys():
-    if key_value.startswith("total_2015"):
-        temp_df = temp_df._append(summary_dict_netcdf[key_value], ignore_index=True)
-
-sns.lineplot(
-    data=temp_df,
-    ax=ax[0][0],
-)
-ax[0][0].set_title("Total CH4 Emission for 2015 \n (Original Data)")
-ax[0][0].set_xlabel("Months")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_cog.keys():
-    if key_value.startswith("total_2015"):
-        temp_df = temp_df._append(summary_dict_cog[key_value], ignore_index=True)
-sns.lineplot(
-    data=temp_df,
-    ax=ax[0][1],
-)
-ax[0][1].set_title("Total CH4 Emission for 2015 \n (Transformed COG Data)")
-ax[0][1].set_xlabel("Months")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_netcdf.keys():
-    if key_value.startswith("microbial_2015"):
-        temp_df = temp_df._append(summary_dict_netcdf[key_value], ignore_index=True)
-
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][0],
-)
-ax[1][0].set_title("Microbial CH4 Emission for 2015 \n (Original Data)")
-ax[1][0].set_xlabel("Months")
-
-temp_df = pd.DataFrame()
-for key_value in summary_dict_cog.keys():
-    if key_value.startswith("microbial_2015"):
-        temp_df = temp_df._append(summary_dict_cog[key_value], ignore_index=True)
-sns.lineplot(
-    data=temp_df,
-    ax=ax[1][1],
-)
-ax[1][1].set_title("Microbial CH4 Emission for 2015 \n (Transformed COG Data)")
-ax[1][1].set_xlabel("Months")
-
-fig.tight_layout(pad=0.5)
-fig.suptitle("Plot for the Statistical values of data", fontsize=10)
-plt.savefig("monthly_stats_summary.png")
-plt.show()
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of files processed in parallel, 1 runs serially",
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="read the COGs from their coarsest overview and report an error bound",
+    )
+    args = parser.parse_args()
+
+    keys = list_keys(s3_client_veda_smce, bucket_name, "gridded_population_cog")
+
+    # List all TIFF files in the folder
+    tif_files = glob("data/gpw/*.tif", recursive=True)
+
+    record_cog = reduce_records(
+        partial(cog_stats, approximate=args.approximate), keys, args.workers
+    )
+    record_netcdf = reduce_records(tif_stats, tif_files, args.workers)
+
+    summary_dict_netcdf, summary_dict_cog = record_netcdf.summary, record_cog.summary
+    overall_stats_netcdf = record_netcdf.overall.to_dict()
+    overall_stats_cog = record_cog.overall.to_dict()
+
+    with open(
+        "monthly_stats.json",
+        "w",
+    ) as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(summary_dict_cog, fp)
+
+    with open("overall_stats.json", "w") as fp:
+        json.dump("Stats for raw netCDF files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_netcdf, fp)
+        fp.write("\n")
+        json.dump("Stats for transformed COG files.", fp)
+        fp.write("\n")
+        json.dump(overall_stats_cog, fp)
+        if args.approximate:
+            fp.write("\n")
+            json.dump("Error bound of the approximate COG stats.", fp)
+            fp.write("\n")
+            json.dump(record_cog.error_bound, fp)
+
+    fig, ax = plt.subplots(2, 2, figsize=(13, 10))
+    sns.histplot(
+        data=record_netcdf.sample("emis_total").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[0][0],
+    )
+    ax[0][0].set_title("Total CH4 Emission \n (Original Data)")
+
+    sns.histplot(
+        data=record_cog.sample("emis_total").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[0][1],
+    )
+    ax[0][1].set_title("Total CH4 Emission \n (Transformed COG Data)")
+
+    sns.histplot(
+        data=record_netcdf.sample("emis_microbial").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[1][0],
+    )
+    ax[1][0].set_title("Microbial CH4 Emission \n (Original Data)")
+
+    sns.histplot(
+        data=record_cog.sample("emis_microbial").values,
+        kde=False,
+        bins=100,
+        legend=False,
+        ax=ax[1][1],
+    )
+    ax[1][1].set_title("Microbial CH4 Emission \n (Transformed COG Data)")
+
+    fig.tight_layout(pad=0.5)
+    fig.suptitle("Overall distribution of data", fontsize=10)
+    plt.savefig("overall_stats_summary.png")
+    plt.show()
+
+    fig, ax = plt.subplots(2, 2, figsize=(12, 12))
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_netcdf.items()
+            if key_value.startswith("total_2015")
+        ]
+    )
+
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[0][0],
+    )
+    ax[0][0].set_title("Total CH4 Emission for 2015 \n (Original Data)")
+    ax[0][0].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_cog.items()
+            if key_value.startswith("total_2015")
+        ]
+    )
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[0][1],
+    )
+    ax[0][1].set_title("Total CH4 Emission for 2015 \n (Transformed COG Data)")
+    ax[0][1].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_netcdf.items()
+            if key_value.startswith("microbial_2015")
+        ]
+    )
+
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][0],
+    )
+    ax[1][0].set_title("Microbial CH4 Emission for 2015 \n (Original Data)")
+    ax[1][0].set_xlabel("Months")
+
+    temp_df = pd.DataFrame(
+        [
+            value
+            for key_value, value in summary_dict_cog.items()
+            if key_value.startswith("microbial_2015")
+        ]
+    )
+    sns.lineplot(
+        data=temp_df,
+        ax=ax[1][1],
+    )
+    ax[1][1].set_title("Microbial CH4 Emission for 2015 \n (Transformed COG Data)")
+    ax[1][1].set_xlabel("Months")
+
+    fig.tight_layout(pad=0.5)
+    fig.suptitle("Plot for the Statistical values of data", fontsize=10)
+    plt.savefig("monthly_stats_summary.png")
+    plt.show()
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class StreamingStats:
+    """Running min/max/mean/std that can be updated with arrays and merged.
+
+    Only the partial moments (count, mean, M2, min, max) are kept, so the
+    overall statistics of a whole archive are computed in a single pass with
+    constant memory. Partial results are combined with the pairwise update of
+    Chan et al., which makes the order of merging irrelevant up to floating
+    point rounding. NaN values are ignored.
+    """
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=np.inf, maximum=-np.inf):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = minimum
+        self.max = maximum
+
+    @classmethod
+    def from_array(cls, data):
+        """Partial moments of a single array (for example one band)."""
+        values = np.asarray(data, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return cls()
+        mean = values.mean()
+        return cls(
+            count=values.size,
+            mean=mean,
+            m2=np.square(values - mean).sum(),
+            minimum=values.min(),
+            maximum=values.max(),
+        )
+
+    def update(self, data):
+        """Add the values of ``data`` to the running statistics."""
+        return self.merge(StreamingStats.from_array(data))
+
+    def merge(self, other):
+        """Combine the partial moments of ``other`` into this instance."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def scaled(self, factor):
+        """Statistics of the same values multiplied by ``factor``."""
+        minimum, maximum = self.min * factor, self.max * factor
+        if factor < 0:
+            minimum, maximum = maximum, minimum
+        return StreamingStats(
+            self.count, self.mean * factor, self.m2 * factor**2, minimum, maximum
+        )
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return np.nan
+        return np.sqrt(self.m2 / self.count)
+
+    def to_dict(self):
+        """Statistics in the format written to the ``*_stats.json`` files."""
+        if self.count == 0:
+            return {
+                "min_value": np.nan,
+                "max_value": np.nan,
+                "mean_value": np.nan,
+                "std_value": np.nan,
+            }
+        return {
+            "min_value": np.float64(self.min),
+            "max_value": np.float64(self.max),
+            "mean_value": np.float64(self.mean),
+            "std_value": np.float64(self.std),
+        }
+
+
+class ReservoirSample:
+    """Bounded uniform random sample of a stream of values.
+
+    Used in place of the full data for the distribution plots. Every value is
+    given a random key and the ``size`` values with the smallest keys are kept,
+    so two samples can be merged and the result is still a uniform sample of
+    everything seen. NaN values are ignored.
+    """
+
+    def __init__(self, size=1_000_000, seed=0):
+        self.size = size
+        self._rng = np.random.default_rng(seed)
+        self._keys = np.empty(0)
+        self._values = np.empty(0)
+
+    def update(self, data):
+        """Offer the values of ``data`` to the sample."""
+        values = np.asarray(data, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        keys = self._rng.random(values.size)
+        if self._keys.size == self.size:
+            # Only values that beat the current worst key can enter the sample
+            keep = keys < self._keys.max()
+            keys, values = keys[keep], values[keep]
+        self._keep(keys, values)
+        return self
+
+    def merge(self, other):
+        """Combine the sample of ``other`` into this instance."""
+        self._keep(other._keys, other._values)
+        return self
+
+    def _keep(self, keys, values):
+        keys = np.concatenate([self._keys, keys])
+        values = np.concatenate([self._values, values])
+        if keys.size > self.size:
+            selected = np.argpartition(keys, self.size)[: self.size]
+            keys, values = keys[selected], values[selected]
+        self._keys, self._values = keys, values
+
+    @property
+    def values(self):
+        return self._values
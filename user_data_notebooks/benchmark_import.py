@@ -0,0 +1,53 @@
+"""Time of ``import ghgc_utils`` in a fresh interpreter.
+
+Fails if the import pulls in one of the heavy dependencies ghgc_utils only
+loads on first use, or takes longer than ``--max-seconds``.
+
+    python benchmark_import.py --repeat 5
+"""
+
+import argparse
+import pathlib
+import subprocess
+import sys
+
+# Modules ghgc_utils must not import when it is imported
+HEAVY_MODULES = ["pandas", "numpy", "matplotlib", "requests", "rasterio", "pystac"]
+
+_SCRIPT = """
+import sys, time
+start_time = time.perf_counter()
+import ghgc_utils
+print(time.perf_counter() - start_time)
+print(",".join(name for name in {modules} if name in sys.modules))
+"""
+
+
+def import_time(modules):
+    """Seconds to import ghgc_utils and the ``modules`` it imported."""
+    output = subprocess.run(
+        [sys.executable, "-c", _SCRIPT.format(modules=modules)],
+        cwd=pathlib.Path(__file__).resolve().parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.splitlines()
+    return float(output[0]), [name for name in output[1].split(",") if name]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=0.2)
+    args = parser.parse_args()
+
+    times = []
+    for _ in range(args.repeat):
+        seconds, imported = import_time(HEAVY_MODULES)
+        times.append(seconds)
+    best = min(times)
+    print(f"import ghgc_utils: {best * 1000:.1f} ms (best of {args.repeat})")
+    if imported:
+        sys.exit(f"ghgc_utils imports {', '.join(imported)} at import time")
+    if best > args.max_seconds:
+        sys.exit(f"ghgc_utils takes more than {args.max_seconds} s to import")
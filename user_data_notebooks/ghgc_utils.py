@@ -1,14 +1,160 @@
-import requests
-import pandas as pd
+from __future__ import annotations
+
 import datetime
-import matplotlib.pyplot as plt
-from matplotlib.colors import rgb2hex
-import numpy as np
 import sys
+import os
+import json
+import gzip
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+import functools
+import importlib
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class LazyObject:
+    """
+    Stands in for a module or object that is only imported or created when one of its attributes is first used, so importing ghgc_utils stays fast in kernels and worker processes that only need part of it. The creation is locked, so threads using it for the first time at once (like the workers of generate_stats()) share a single session or client. Inputs: load = function returning the module or object.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._value = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._load()
+        return getattr(self._value, name)
+
+# The heavy dependencies are imported on first use
+pd = LazyObject(lambda: importlib.import_module("pandas"))
+np = LazyObject(lambda: importlib.import_module("numpy"))
+plt = LazyObject(lambda: importlib.import_module("matplotlib.pyplot"))
+
+# Number of Raster API requests generate_stats() sends at the same time
+MAX_WORKERS = 8
+
+def create_session():
+    """
+    Returns the HTTP session used for all Raster API requests, so the connection (and its TLS handshake) is reused between items. Its pool keeps a connection per worker, and requests the API answers with 429 (rate limited) or a 5xx error are retried with a backoff doubling between attempts, or waiting as long as the API asks for in its Retry-After header.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,
+        ),
+    ))
+    return session
+
+session = LazyObject(create_session)
+
+def geometry_hash(geojson):
+    """
+    Hash of a GeoJSON object. It is serialised with sorted keys and no whitespace first, so the same geometry always gives the same hash.
+    """
+    return hashlib.sha256(json.dumps(geojson, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+class StatsCache:
+    """
+    Disk cache of Raster API responses, shared by all notebook sessions. Inputs: path = SQLite file, ttl = seconds a response stays valid, max_entries = number of responses kept, the least recently used ones are dropped first. Responses are keyed by the asset href, the geometry (or request parameters) and the Raster API url.
+    """
+
+    def __init__(self, path=os.path.join(os.path.expanduser("~"), ".cache", "ghgc-docs", "raster_stats.sqlite"), ttl=7 * 24 * 3600, max_entries=100_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Opened on first use, so importing ghgc_utils does not create the file
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, href TEXT, url TEXT, response TEXT, created REAL, used REAL)"
+            )
+        return self._connection
+
+    @staticmethod
+    def key(href, geojson, url):
+        """
+        Cache key of a request, from the asset href, geometry_hash() of the geometry and the Raster API url.
+        """
+        return hashlib.sha256("\n".join([href, geometry_hash(geojson), url]).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None if there is none or it is older than ttl.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT response FROM stats WHERE key = ? AND created > ?", (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            with connection:
+                connection.execute("UPDATE stats SET used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, response, href="", url=""):
+        """
+        Stores a response, then drops the expired responses and the least recently used ones above max_entries.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?)", (key, href, url, json.dumps(response), now, now))
+                connection.execute("DELETE FROM stats WHERE created <= ?", (now - self.ttl,))
+                connection.execute(
+                    "DELETE FROM stats WHERE key IN (SELECT key FROM stats ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+                )
+
+    def invalidate(self, href=None, url=None):
+        """
+        Drops the cached responses for an asset href and/or a Raster API url, or all of them if neither is given.
+        """
+        conditions = [(column, value) for column, value in (("href", href), ("url", url)) if value is not None]
+        where = " AND ".join(f"{column} = ?" for column, _ in conditions) or "1"
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(f"DELETE FROM stats WHERE {where}", [value for _, value in conditions])
+
+# Disk cache to pass as cache=stats_cache to raster_stats() and generate_stats(), nothing is cached otherwise. An asset
+# reprocessed under the same href keeps its old statistics for up to ttl: clear them with stats_cache.invalidate(href=...),
+# or all of them with stats_cache.invalidate().
+stats_cache = StatsCache()
+
+def asset_href(item, asset):
+    """
+    Returns the url of an asset of an item, given as a dictionary or a pystac Item.
+    """
+    try:
+        return item["assets"][asset]["href"]
+    except TypeError:
+        return item.assets[asset].href
 
 def raster_stats(item, geojson,**kwargs):
     """
-    Returns Raster API statistics for an item. Inputs: item, geojson, url = Raster API url, asset = asset name within item. Outputs: dictionary containing statistics over the bounding box and item's datetime information.
+    Returns Raster API statistics for an item. Inputs: item, geojson, url = Raster API url, asset = asset name within item, optional cache = StatsCache the responses are read from and stored in, e.g. stats_cache (None by default, always calling the API), optional backend = "api" (default) or "local" to compute the statistics from the COG with local_stats() instead of calling the Raster API. Outputs: dictionary containing statistics over the bounding box and item's datetime information.
     """
 
     try:
@@ -19,21 +165,7 @@ def raster_stats(item, geojson,**kwargs):
         print('KeyError in raster_stats: Make sure you include \'url\' and \'asset\' as keyword arguments!')
         sys.exit()      
     
-    # A POST request is made to submit the data associated with the item of interest (specific observation) within the boundaries of the polygon to compute its statistics
-    result = requests.post(
-
-        # Raster API Endpoint for computing statistics
-        f"{kwargs['url']}/cog/statistics",
-
-        # Pass the URL to the item, asset name, and raster identifier as parameters
-        params={"url": url},
-
-        # Send the GeoJSON object (polygon) along with the request
-        json=geojson,
-
-    # Return the response in JSON format
-    ).json()
-
+    result = cached_stats(url, geojson, kwargs.get("url"), kwargs.get("cache"), kwargs.get("backend", "api"))
 
     # Print the result
     ##print(result)
@@ -67,106 +199,603 @@ def raster_stats(item, geojson,**kwargs):
                 "datetime": item.properties["datetime"]
             }
 
-def clean_stats(stats_json) -> pd.DataFrame:
+def cached_stats(href, geojson, api_url, cache=None, backend="api"):
     """
-    Takes dictionary output from generate_stats() and returns a neater, more intuitively-titled pandas DataFrame.
+    Returns the Raster API response for the statistics of an asset over a geometry, from cache if it holds it. Inputs: href = asset url, geojson, api_url = Raster API url, cache = StatsCache or None, backend = "api" or "local". Outputs: the JSON response.
     """
-    pd.set_option('display.float_format', '{:.20f}'.format)
-    stats_json_ = [stats_json[datetime] for datetime in stats_json] 
-    # Normalize the JSON data 
-    df = pd.json_normalize(stats_json_)
+    if backend == "local":
+        api_url = "local"
+    # Reuse the statistics computed for the same asset and geometry in an earlier request
+    result = None
+    if cache is not None:
+        cache_key = cache.key(href, geojson, api_url)
+        result = cache.get(cache_key)
+    if result is None:
+        result = local_stats(href, geojson) if backend == "local" else fetch_stats(href, geojson, api_url)
+        # Only statistics are kept, an error is requested again the next time
+        if cache is not None and ("properties" in result or "features" in result):
+            cache.put(cache_key, result, href=href, url=api_url)
+    return result
 
-    # Replace the naming "statistics.b1" in the columns
-    df.columns = [col.replace("statistics.b1.", "") for col in df.columns]
+def fetch_stats(href, geojson, api_url):
+    """
+    Requests the statistics of an asset over a geometry from the Raster API. Inputs: href = asset url, geojson, api_url = Raster API url. Outputs: the JSON response.
+    """
+    # A POST request is made to submit the data associated with the item of interest (specific observation) within the boundaries of the polygon to compute its statistics
+    return session.post(
 
-    # Set the datetime format
-    df["date"] = pd.to_datetime(df["datetime"])
+        # Raster API Endpoint for computing statistics
+        f"{api_url}/cog/statistics",
 
-    # Return the cleaned format
-    return df
+        # Pass the URL to the item, asset name, and raster identifier as parameters
+        params={"url": href},
+
+        # Send the GeoJSON object (polygon) along with the request
+        json=geojson,
+
+    # Return the response in JSON format
+    ).json()
+
+# GDAL configuration for reading the COGs of the local backend: range requests for the header and the tiles in the geometry
+# only, merged when they are next to each other, and no listing of the S3 "directory" of every file. A copy of GDAL_OPTIONS
+# in generating_statistics_for_validation/cog_env.py, the notebooks folder is used on its own and cannot import it: keep
+# the two the same.
+GDAL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.TIF,.tiff",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(64 * 1024 * 1024),
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 * 1024 * 1024),
+    "GDAL_CACHEMAX": 512,
+    "GDAL_HTTP_VERSION": "2TLS",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_TCP_KEEPALIVE": "YES",
+    "GDAL_HTTP_MAX_RETRY": 3,
+    "GDAL_HTTP_RETRY_DELAY": 1,
+}
+
+# Masks of geometries on the grids of the collections. All the dates of a collection share a grid, so the mask of a
+# geometry is computed once, kept in memory (the MAX_MASKS last used) and saved compressed in MASK_DIR for the next
+# sessions. Threads asking for the same mask wait for the one computing it.
+MASK_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ghgc-docs", "masks")
+MAX_MASKS = 256
+_geometry_masks = OrderedDict()
+_mask_locks = {}
+_mask_locks_lock = threading.Lock()
+
+def _remember_mask(key, value):
+    _geometry_masks[key] = value
+    _geometry_masks.move_to_end(key)
+    while len(_geometry_masks) > MAX_MASKS:
+        _geometry_masks.popitem(last=False)
+    return value
+
+def geometry_window_mask(src, geometry, coverage=False):
+    """
+    Returns the window of src covering geometry and a mask of that window. Inputs: src = open rasterio dataset, geometry = GeoJSON geometry in EPSG:4326, coverage = False for a boolean mask, True outside of the geometry, or True for the fraction of every pixel covered by the geometry (0 to 1). Outputs: (window, mask), an empty window and mask when
+    the geometry is outside of src.
+    """
+    key = (tuple(src.transform), src.shape, str(src.crs), geometry_hash(geometry), coverage)
+    with _mask_locks_lock:
+        if key in _geometry_masks:
+            _geometry_masks.move_to_end(key)
+            return _geometry_masks[key]
+        lock = _mask_locks.setdefault(key, threading.Lock())
+    with lock:
+        with _mask_locks_lock:
+            value = _geometry_masks.get(key)
+        if value is None:
+            value = _load_or_compute_mask(src, geometry, coverage, key)
+            with _mask_locks_lock:
+                _remember_mask(key, value)
+                _mask_locks.pop(key, None)
+    return value
+
+def _load_or_compute_mask(src, geometry, coverage, key):
+    from rasterio.errors import WindowError
+    from rasterio.features import bounds, geometry_mask
+    from rasterio.warp import transform_geom
+    from rasterio.windows import Window, from_bounds
+
+    path = os.path.join(MASK_DIR, hashlib.sha256(repr(key).encode()).hexdigest() + ".npz")
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            col_off, row_off, width, height = stored["window"].tolist()
+            return Window(col_off, row_off, width, height), stored["mask"]
+
+    if src.crs and src.crs.to_epsg() != 4326:
+        geometry = transform_geom("EPSG:4326", src.crs, geometry)
+    window = from_bounds(*bounds(geometry), transform=src.transform).round_offsets().round_lengths()
+    try:
+        window = window.intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        # The geometry does not overlap the raster
+        return Window(0, 0, 0, 0), np.zeros((0, 0), dtype="float32" if coverage else bool)
+    shape = (int(window.height), int(window.width))
+    transform = src.window_transform(window)
+    if coverage:
+        # Rasterise 10 times finer and count the covered sub-pixels of every pixel
+        inside = ~geometry_mask([geometry], out_shape=(shape[0] * 10, shape[1] * 10), transform=transform * transform.scale(0.1))
+        mask = inside.reshape(shape[0], 10, shape[1], 10).mean(axis=(1, 3), dtype="float32")
+    else:
+        mask = geometry_mask([geometry], out_shape=shape, transform=transform)
+
+    # Written to a temporary file of its own and renamed, so that other processes only see complete files
+    os.makedirs(MASK_DIR, exist_ok=True)
+    fd, part = tempfile.mkstemp(dir=MASK_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            np.savez_compressed(fp, window=np.array([window.col_off, window.row_off, window.width, window.height]), mask=mask)
+        os.replace(part, path)
+    except BaseException:
+        os.remove(part)
+        raise
+    return window, mask
+
+def stack_stats(data, coverage=None):
+    """
+    Returns the statistics of every time step of a masked (time, y, x) array in the format of the Raster API for one band. The moments and percentiles are computed for all time steps at once. Inputs: data, optional coverage = (y, x) fraction of every pixel in the geometry, which weights the count, sum, mean and std as the Raster API does. Outputs: list of dictionaries, one per time step.
+    """
+    flat = data.reshape(data.shape[0], -1)
+    valid = ~np.ma.getmaskarray(flat)
+    weights = valid * (np.ones(flat.shape[1]) if coverage is None else np.ravel(coverage))
+    values = flat.filled(0).astype("float64")
+    valid_pixels = valid.sum(axis=1)
+    count = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = (values * weights).sum(axis=1)
+        mean = total / count
+        std = np.sqrt((weights * (values - mean[:, None]) ** 2).sum(axis=1) / count)
+    minimum = np.min(values, axis=1, initial=np.inf, where=valid)
+    maximum = np.max(values, axis=1, initial=-np.inf, where=valid)
+    percentiles = np.full((3, flat.shape[0]), np.nan)
+    rows = valid.any(axis=1)
+    if rows.any():
+        percentiles[:, rows] = np.nanpercentile(np.where(valid, values, np.nan)[rows], [2, 50, 98], axis=1)
+
+    stats = []
+    for t in range(flat.shape[0]):
+        common = {
+            "valid_pixels": float(valid_pixels[t]),
+            "masked_pixels": float(flat.shape[1] - valid_pixels[t]),
+            "valid_percent": round(100 * float(valid_pixels[t]) / flat.shape[1], 2) if flat.shape[1] else 0.0,
+        }
+        if not valid_pixels[t]:
+            stats.append({"min": None, "max": None, "mean": None, "count": 0.0, "sum": 0.0, "std": None, "median": None, "majority": None, "minority": None, "unique": 0.0, "histogram": [[], []], **common})
+            continue
+        row = values[t][valid[t]]
+        unique, counts = np.unique(row, return_counts=True)
+        histogram, edges = np.histogram(row, bins=10)
+        stats.append({
+            "min": float(minimum[t]),
+            "max": float(maximum[t]),
+            "mean": float(mean[t]),
+            "count": float(count[t]),
+            "sum": float(total[t]),
+            "std": float(std[t]),
+            "median": float(percentiles[1, t]),
+            "majority": float(unique[np.argmax(counts)]),
+            "minority": float(unique[np.argmin(counts)]),
+            "unique": float(unique.size),
+            "histogram": [histogram.tolist(), edges.tolist()],
+            **common,
+            "percentile_2": float(percentiles[0, t]),
+            "percentile_98": float(percentiles[2, t]),
+        })
+    return stats
+
+def band_stats(data, coverage=None):
+    """
+    Returns the statistics of a masked (y, x) array in the format of the Raster API for one band.
+    """
+    return stack_stats(data[np.newaxis], coverage)[0]
+
+def read_window(href, geometry, coverage=False):
+    """
+    Reads the window of an asset covering geometry. Inputs: href = asset url (s3://, https:// or a local file), geometry = GeoJSON geometry in EPSG:4326, coverage as for geometry_window_mask(). Outputs: (band indexes, masked (band, y, x) array masked outside of the geometry, coverage fractions or None,
+    grid = (transform of the window, CRS) identifying the pixels read).
+    """
+    import rasterio
+
+    with rasterio.Env(**GDAL_OPTIONS), rasterio.open(href) as src:
+        window, mask = geometry_window_mask(src, geometry, coverage)
+        if window.width and window.height:
+            data = src.read(window=window, masked=True)
+        else:
+            data = np.ma.masked_all((src.count, 0, 0), dtype=src.dtypes[0])
+        indexes = src.indexes
+        grid = (tuple(src.window_transform(window)), str(src.crs))
+    data.mask = np.ma.getmaskarray(data) | (mask == 0 if coverage else mask)
+    return indexes, data, mask if coverage else None, grid
+
+def local_stats(href, geojson, coverage=False):
+    """
+    Computes the statistics of an asset over a geometry from the COG itself, reading only the tiles inside the geometry. Inputs: href = asset url (s3://, https:// or a local file), geojson = Feature or FeatureCollection, coverage = True to weight the pixels by the fraction covered by the geometry. Outputs: the same JSON as the Raster API /cog/statistics response, so clean_stats() works on it.
+    """
+    features = geojson["features"] if geojson.get("type") == "FeatureCollection" else [geojson]
+    results = []
+    for feature in features:
+        geometry = feature["geometry"] if feature.get("type") == "Feature" else feature
+        indexes, data, weights, _ = read_window(href, geometry, coverage)
+        results.append({
+            "type": "Feature",
+            "geometry": geometry,
+            "properties": {
+                **(feature.get("properties") or {}),
+                "statistics": {f"b{band}": band_stats(band_data, weights) for band, band_data in zip(indexes, data)},
+            },
+        })
+    if geojson.get("type") == "FeatureCollection":
+        return {"type": "FeatureCollection", "features": results}
+    return results[0]
+
+def local_stats_stack(hrefs, geojson, workers=MAX_WORKERS, coverage=False):
+    """
+    Computes the statistics of many dates of a collection over one geometry. The windows are read concurrently and the assets sharing a grid are reduced together as one (time, y, x) array, with the geometry mask computed once. Inputs: hrefs = asset urls, geojson = geometry or Feature, workers = number of assets read at the same time, coverage as for local_stats(). Outputs: list of responses in the format of local_stats(), in the order of hrefs.
+    """
+    geometry = geojson["geometry"] if geojson.get("type") == "Feature" else geojson
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        windows = list(executor.map(lambda href: read_window(href, geometry, coverage), hrefs))
+
+    # Group the assets by grid, the ones of a collection normally all share one and so the same coverage weights
+    groups = {}
+    for position, (indexes, data, weights, grid) in enumerate(windows):
+        groups.setdefault((tuple(indexes), data.shape, grid), []).append(position)
+    statistics = [{} for _ in hrefs]
+    for (indexes, _, _), positions in groups.items():
+        stack = np.ma.stack([windows[position][1] for position in positions])
+        weights = windows[positions[0]][2]
+        for band_position, band in enumerate(indexes):
+            for position, stats in zip(positions, stack_stats(stack[:, band_position], weights)):
+                statistics[position][f"b{band}"] = stats
+    properties = (geojson.get("properties") or {}) if geojson.get("type") == "Feature" else {}
+    return [
+        {"type": "Feature", "geometry": geometry, "properties": {**properties, "statistics": stats}}
+        for stats in statistics
+    ]
+
+def flatten_stats(result, prefix=""):
+    """
+    Flattens the nested dictionaries of a statistics result into "parent.child" keys, as pandas.json_normalize() does, with "statistics.b1." left out of the names of the first band's statistics.
+    """
+    flat = {}
+    for key, value in result.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_stats(value, f"{name}."))
+        else:
+            flat[name.replace("statistics.b1.", "")] = value
+    return flat
+
+class StatsColumns:
+    """
+    Builds the DataFrame of many statistics results column by column. Every statistic gets one NumPy array preallocated for all rows, filled as the results arrive in any order, and the DataFrame is made once at the end. Inputs: size = number of rows.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.columns = {}
 
-def generate_stats(items,geojson,**kwargs):
+    def set(self, row, result):
+        """
+        Fills a row with a result of raster_stats().
+        """
+        for name, value in flatten_stats(result).items():
+            if self.columns.get(name) is None:
+                if value is None:
+                    # The type of the column is set by its first value that is not None, a None in a float array is NaN
+                    self.columns[name] = None
+                    continue
+                # Numbers go in float arrays, everything else (datetimes, histograms, names) in object arrays
+                numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+                self.columns[name] = np.full(self.size, np.nan) if numeric else np.full(self.size, None, dtype=object)
+            self.columns[name][row] = value
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Returns the DataFrame of the results, with a "date" column holding the parsed "datetime".
+        """
+        columns = {name: np.full(self.size, None, dtype=object) if column is None else column for name, column in self.columns.items()}
+        df = pd.DataFrame(columns, copy=False)
+        df["date"] = pd.to_datetime(df["datetime"])
+        return df
+
+def clean_stats(stats_json) -> pd.DataFrame:
+    """
+    Takes dictionary output from generate_stats() and returns a neater, more intuitively-titled pandas DataFrame.
     """
-    Runs raster_stats() and clean-stats() on all items. Inputs: List containing multiple items; geojson; url = URL for Raster API, asset = asset name for item field. Outputs: Pandas DataFrame of cleaned statistics for all items in list.
+    columns = StatsColumns(len(stats_json))
+    for row, result in enumerate(stats_json.values()):
+        columns.set(row, result)
+    return columns.to_frame()
+
+def generate_stats(items,geojson,workers=MAX_WORKERS,**kwargs):
+    """
+    Runs raster_stats() and clean-stats() on all items. Inputs: List containing multiple items; geojson; url = URL for Raster API, asset = asset name for item field; optional workers = number of requests sent at the same time (1 sends them one after the other), optional cache and backend as for raster_stats(). Outputs: Pandas DataFrame of cleaned statistics for all items in list.
     """
-    stats = {}
+    items = list(items)
     print('Generating stats...')
-    for item in items:
+    if kwargs.get("backend") == "local" and geojson.get("type") != "FeatureCollection":
+        # Compute all dates in one stacked reduction, raster_stats() then finds them in the cache
+        cache = kwargs.get("cache") or StatsCache(":memory:")
+        kwargs = {**kwargs, "cache": cache}
+        hrefs = [asset_href(item, kwargs["asset"]) for item in items]
+        missing = [href for href in hrefs if cache.get(cache.key(href, geojson, "local")) is None]
+        for href, result in zip(missing, local_stats_stack(missing, geojson, workers)):
+            cache.put(cache.key(href, geojson, "local"), result, href=href, url="local")
+    # Send the requests concurrently and fill the row of every item, keyed by its full datetime, as its result arrives
+    columns = StatsColumns(len(items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(raster_stats, item, geojson, **kwargs): row for row, item in enumerate(items)}
+        for future in as_completed(futures):
+            columns.set(futures[future], future.result())
+    df = columns.to_frame()
+    print('Done!')
+    return df
+
+def generate_region_stats(items,regions,workers=MAX_WORKERS,**kwargs):
+    """
+    Runs the statistics of all items over several regions, sending all regions of an item to the Raster API in one FeatureCollection. Inputs: List containing multiple items; regions = dictionary of region name to GeoJSON geometry or Feature; url = URL for Raster API, asset = asset name for item field; optional workers and cache as for generate_stats() and raster_stats(). Outputs: Pandas DataFrame of cleaned statistics indexed by (region, datetime).
+    """
+    items = list(items)
+    # One Feature per region, named in its properties so that it can be matched in the response
+    feature_collection = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": region["geometry"] if region.get("type") == "Feature" else region,
+                "properties": {"region": name},
+            }
+            for name, region in regions.items()
+        ],
+    }
+
+    def item_stats(item):
         try:
-            date = item["properties"]["start_datetime"]  # Get the associated date
+            href = item["assets"][kwargs["asset"]]["href"]
+            date = item["properties"].get("start_datetime", item["properties"].get("datetime"))
         except TypeError:
-            try:
-                date = item.properties["start_datetime"]
-            except KeyError:
-                date = item.properties["datetime"]
-        year_month = date[:10].replace('-', '')  # Convert datetime to year-month
-        stats[year_month] = raster_stats(item, geojson,**kwargs)
-    df = clean_stats(stats)
+            href = item.assets[kwargs["asset"]].href
+            date = item.properties.get("start_datetime", item.properties.get("datetime"))
+        result = cached_stats(href, feature_collection, kwargs.get("url"), kwargs.get("cache"), kwargs.get("backend", "api"))
+        return [{**feature["properties"], "datetime": date} for feature in result["features"]]
+
+    print('Generating stats...')
+    columns = StatsColumns(len(items) * len(regions))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(item_stats, item): position for position, item in enumerate(items)}
+        for future in as_completed(futures):
+            for offset, row in enumerate(future.result()):
+                columns.set(futures[future] * len(regions) + offset, row)
+    df = columns.to_frame().drop(columns="date")
+    df["datetime"] = pd.to_datetime(df["datetime"])
+    df = df.set_index(["region", "datetime"]).sort_index()
     print('Done!')
     return df
 
-def generate_html_colorbar(color_map,rescale_values,label=None,dark=False):
+# Local copies of the STAC items of the collections, one gzipped JSON lines file per collection
+STAC_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ghgc-docs", "stac")
+
+def item_datetime(item):
+    """
+    Returns the start datetime of an item dictionary, or its datetime if it has no start datetime.
+    """
+    return item["properties"].get("start_datetime") or item["properties"]["datetime"]
+
+def fetch_items(catalog, collection, start, end):
+    """
+    Returns the item dictionaries of a collection between two datetimes (ISO strings, None for an open end), following the pages of the search.
+    """
+    return list(catalog.search(collections=collection, datetime=[start, end], limit=1000).items_as_dicts())
+
+def search_items(stac_api_url, collection, datetime_range=None, refresh=True, workers=MAX_WORKERS, cache_dir=STAC_CACHE_DIR) -> pd.Series:
+    """
+    Returns the items of a collection from a local copy, updated from the STAC API. The first time, the temporal extent of the collection is split by year and the years are searched concurrently (an extent without a start begins at the start of datetime_range, or is searched at once without one); afterwards only the items from the newest datetime already stored onwards are fetched. Inputs: stac_api_url, collection = collection name, optional datetime_range = [start, end] to select, refresh = True to fetch the new items (default), "full" to fetch everything again, False to only read the local copy, workers = number of years searched at the same time. Outputs: pandas Series of pystac Items indexed by their start datetime, e.g. items.loc["2020-03"] for the items of March 2020.
+    """
+    import pystac
+    from pystac_client import Client
+
+    path = os.path.join(cache_dir, f"{collection}.jsonl.gz")
+    stored = {}
+    if os.path.exists(path) and refresh != "full":
+        with gzip.open(path, "rt") as fp:
+            for line in fp:
+                item = json.loads(line)
+                stored[item["id"]] = item
+
+    if refresh:
+        catalog = Client.open(stac_api_url)
+        if stored:
+            # Items from the newest stored datetime onwards, including it in case more items of that date were added
+            ranges = [(max(item_datetime(item) for item in stored.values()), None)]
+        else:
+            start, end = catalog.get_collection(collection).extent.temporal.intervals[0]
+            if start is None and datetime_range is not None and datetime_range[0] is not None:
+                # An extent without a start is searched from the start of the requested range
+                start = pd.to_datetime(datetime_range[0], utc=True)
+            end = end or pd.Timestamp.now(tz="UTC")
+            if start is None:
+                # Nothing to split by year, the whole collection is searched at once
+                ranges = [(None, None)]
+            else:
+                years = range(start.year, end.year + 1)
+                ranges = [(f"{year}-01-01T00:00:00Z", f"{year}-12-31T23:59:59Z") for year in years]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for items in executor.map(lambda dates: fetch_items(catalog, collection, *dates), ranges):
+                stored.update((item["id"], item) for item in items)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # Each process writes its own partial file, so kernels refreshing the same collection do not mix their writes
+        fd, partial_path = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as fp:
+            for item in stored.values():
+                fp.write(json.dumps(item) + "\n")
+        os.replace(partial_path, path)
+
+    items = pd.Series(
+        [pystac.Item.from_dict(item) for item in stored.values()],
+        index=pd.to_datetime([item_datetime(item) for item in stored.values()], utc=True),
+        dtype=object,
+    ).sort_index()
+    if datetime_range is not None:
+        items = items.loc[datetime_range[0]:datetime_range[1]]
+    return items
+
+# Cache used by get_tilejson() for the tilejson.json responses
+tilejson_cache = StatsCache(os.path.join(os.path.expanduser("~"), ".cache", "ghgc-docs", "tilejson.sqlite"))
+
+def get_tilejson(api_url, collection_id, item_id, cache=tilejson_cache, **params):
+    """
+    Returns the tilejson.json of an item from the Raster API, from cache if it was already requested with the same parameters. Inputs: api_url = Raster API url, collection_id, item_id, optional cache = StatsCache or None, params = query parameters, e.g. assets, colormap_name, rescale. Outputs: the tilejson dictionary.
+    """
+    url = f"{api_url}/collections/{collection_id}/items/{item_id}/tilejson.json"
+    if cache is not None:
+        key = cache.key(url, params, api_url)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    result = response.json()
+    if cache is not None:
+        cache.put(key, result, href=url, url=api_url)
+    return result
+
+def tile_range(bbox, zoom):
+    """
+    Returns the x and y ranges of the web mercator tiles covering bbox = (west, south, east, north) at a zoom level.
+    """
+    west, south, east, north = bbox
+    n = 2 ** zoom
+    def x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+    def y(lat):
+        lat = max(-85.0511, min(85.0511, lat))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)))
+    return range(x(west), x(east) + 1), range(y(north), y(south) + 1)
+
+def prefetch_tiles(tilejson, bbox, zooms, path, workers=MAX_WORKERS):
+    """
+    Downloads the tiles of a tilejson covering a bounding box into an MBTiles file, skipping the tiles it already holds. Inputs: tilejson = output of get_tilejson(), bbox = (west, south, east, north), zooms = zoom levels, e.g. range(3, 8), path = MBTiles file, workers = number of tiles downloaded at the same time. Outputs: path.
+    """
+    template = tilejson["tiles"][0]
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", [("name", os.path.basename(path)), ("format", "png"), ("bounds", ",".join(str(value) for value in bbox))])
+    # MBTiles number the rows from the south (TMS), web maps from the north (XYZ)
+    stored = set(connection.execute("SELECT zoom_level, tile_column, (1 << zoom_level) - 1 - tile_row FROM tiles"))
+    missing = [
+        (z, x, y)
+        for z in zooms
+        for xs, ys in [tile_range(bbox, z)]
+        for x in xs
+        for y in ys
+        if (z, x, y) not in stored
+    ]
+
+    def fetch(tile):
+        z, x, y = tile
+        response = session.get(template.replace("{z}", str(z)).replace("{x}", str(x)).replace("{y}", str(y)))
+        return tile, response.content if response.status_code == 200 else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, connection:
+        for (z, x, y), data in executor.map(fetch, missing):
+            if data is not None:
+                connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, (1 << z) - 1 - y, data))
+        # Zoom levels of all the tiles held, this run's and the previous ones'
+        minzoom, maxzoom = connection.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles").fetchone()
+        if minzoom is not None:
+            connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", [("minzoom", str(minzoom)), ("maxzoom", str(maxzoom))])
+    connection.close()
+    return path
+
+# Local tile servers started by serve_mbtiles(), by MBTiles file
+_tile_servers = {}
+
+def serve_mbtiles(path, proxy=None):
     """
-    Creates html-formatted string which can be added to Folium maps to display a colorbar. Required inputs: colormap (matplotlib-accepted string), rescale_values in the form of a dictionary containing keys 'max' and 'min' which specify the desired colorbar range. Optional inputs: label, which will display above the colorbar. Output: html-formatted string detailing construction of the colorbar.
+    Serves the tiles of an MBTiles file over HTTP from the machine running the kernel, for folium maps to load them from disk instead of the Raster API. The tiles are loaded by the browser: on a local Jupyter the url points at the server directly, on JupyterHub (e.g. the GHGC hub) at the server through jupyter-server-proxy, which must be installed on the hub, as the browser cannot reach the kernel's 127.0.0.1. Inputs: path = MBTiles file written by prefetch_tiles(), proxy = url prefix of the hub's server proxy, by default "<JUPYTERHUB_SERVICE_PREFIX>proxy/" on JupyterHub and none otherwise. Outputs: tile url template to pass as folium.TileLayer(tiles=...).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    path = os.path.abspath(path)
+    if path not in _tile_servers:
+        class TileHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    z, x, y = (int(part) for part in self.path.split("?")[0].strip("/").removesuffix(".png").split("/"))
+                except ValueError:
+                    self.send_error(404)
+                    return
+                with sqlite3.connect(path) as connection:
+                    row = connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, (1 << z) - 1 - y)).fetchone()
+                if row is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                self.wfile.write(row[0])
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        _tile_servers[path] = server
+    port = _tile_servers[path].server_port
+    if proxy is None and os.environ.get("JUPYTERHUB_SERVICE_PREFIX"):
+        proxy = os.environ["JUPYTERHUB_SERVICE_PREFIX"].rstrip("/") + "/proxy/"
+    if proxy:
+        return f"{proxy.rstrip('/')}/{port}/{{z}}/{{x}}/{{y}}.png"
+    return f"http://127.0.0.1:{port}/{{z}}/{{x}}/{{y}}.png"
+
+def generate_html_colorbar(color_map,rescale_values,label=None,dark=False,stops=11):
     """
+    Creates html-formatted string which can be added to Folium maps to display a colorbar. Required inputs: colormap (matplotlib-accepted string), rescale_values in the form of a dictionary containing keys 'max' and 'min' which specify the desired colorbar range. Optional inputs: label, which will display above the colorbar; stops, the number of colors of the gradient (11 by default). Output: html-formatted string detailing construction of the colorbar.
+    """
+    return colorbar_html(color_map, rescale_values['min'], rescale_values['max'], label, dark, stops)
+
+@functools.lru_cache(maxsize=256)
+def colorbar_html(color_map, vmin, vmax, label=None, dark=False, stops=11):
+    """
+    Builds the html of generate_html_colorbar(), the html of the same colormap, range, label and theme is only built once. Raises ValueError when stops (number of color stops of the gradient) is below 2.
+    """
+    if stops < 2:
+        raise ValueError(f"stops must be at least 2, got {stops}")
     # Pull out colors from our chosen colormap
     cmap = plt.get_cmap(color_map)
-    colors = cmap(np.linspace(0,1,11))
-    colors = [rgb2hex(c) for c in colors]
+    from matplotlib.colors import rgb2hex
+
+    colors = [rgb2hex(c) for c in cmap(np.linspace(0,1,stops))]
     # Define custom tick values for the legend bar
-    tick_val = np.round(np.linspace(rescale_values['min'],rescale_values['max'],5),decimals=6)
-    # Create a HTML representation
-    legend_html = cmap._repr_html_()
-
-    # Create a customized HTML structure for the legend
-#    legend_html = f'''
-#    <div style="position: fixed; bottom: 50px; left: 175px; z-index: 1000; width: 400px; height: auto; #background-color: rgba(255, 255, 255, 0.8);
-#             border-radius: 5px; border: 1px solid grey; padding: 10px; font-size: 12px; color: black;">
-#        <b>{label}</b><br>
-#        <div style="display: flex; justify-content: space-between;">
-#            <div>{tick_val[0]}</div> 
-#            <div>{tick_val[1]}</div> 
-#            <div>{tick_val[2]}</div> 
-#            <div>{tick_val[3]}</div> 
-#            <div>{tick_val[4]}</div> 
-#        </div>
-#        <div style="background: linear-gradient(to right,
-#                {colors[0]}, {colors[1]} {20}%,
-#                {colors[1]} {20}%, {colors[2]} {40}%,
-#                {colors[2]} {40}%, {colors[3]} {50}%,
-#                {colors[3]} {50}%, {colors[4]} {80}%,
-#                {colors[4]} {80}%, {colors[5]}); height: 10px;"></div>
-#    </div>
-#    '''
+    tick_val = np.round(np.linspace(vmin,vmax,5),decimals=6)
+
     if dark:
         bg_color = "rgba(0, 0, 0, 0.8)"
         font_color="white"
     else:
         bg_color = "rgba(255, 255, 255, 0.8)"
         font_color="black"
-    
+
+    # One color stop every 100 / (stops - 1) percent of the bar
+    gradient = ",\n                ".join(f"{color} {100 * i / (stops - 1):g}%" for i, color in enumerate(colors))
+    ticks = "\n            ".join(f"<div>{tick}</div>" for tick in tick_val)
+
     legend_html = f'''
     <div style="position: fixed; bottom: 50px; left: 175px; z-index: 1000; width: 400px; height: auto; background-color: {bg_color};
              border-radius: 5px; border: 1px solid grey; padding: 10px; font-size: 12px; color: {font_color};">
         <b>{label}</b><br>
         <div style="display: flex; justify-content: space-between;">
-            <div>{tick_val[0]}</div> 
-            <div>{tick_val[1]}</div> 
-            <div>{tick_val[2]}</div> 
-            <div>{tick_val[3]}</div> 
-            <div>{tick_val[4]}</div>
+            {ticks}
         </div>
         <div style="background: linear-gradient(to right,
-                {colors[0]}, {colors[1]} {10}%,
-                {colors[1]} {10}%, {colors[2]} {20}%,
-                {colors[2]} {20}%, {colors[3]} {30}%,
-                {colors[3]} {30}%, {colors[4]} {40}%,
-                {colors[4]} {40}%, {colors[5]} {50}%,
-                {colors[5]} {50}%, {colors[6]} {60}%,
-                {colors[6]} {60}%, {colors[7]} {70}%,
-                {colors[7]} {70}%, {colors[8]} {80}%,
-                {colors[8]} {80}%, {colors[9]} {90}%,
-                {colors[9]} {90}%, {colors[10]}); height: 10px;"></div>
+                {gradient}); height: 10px;"></div>
     </div>
     '''
-    return legend_html
\ No newline at end of file
+    return legend_html